@@ -1,77 +1,290 @@
+import datetime
 import os
 import json
+import re
+import threading
+import time
+
 import boto3
+from botocore.config import Config
 
+from cache import TTLCache
+from metrics import RunMetrics
+import profiling
+from scheduler import get_scheduler, is_throttling
+import utils
 
-defaults = {
-    "query_instances": """
-        SELECT
-            resourceId,
-            configuration.imageId,
-            configuration.blockDeviceMappings,
-            configuration.vpcId,
-            tags,
-            relationships
-        WHERE
-            resourceType = 'AWS::EC2::Instance'
-            AND configuration.state.name = 'running'
-            OR configuration.state.name = 'stopped'
-    """,
-    "query_vpcs": """
-        SELECT
-            resourceId,
-            tags
-        WHERE
-            resourceType = 'AWS::EC2::VPC'
+
+def build_Config_query(resource_type, fields, conditions=[]):
     """
+    Build a Config SELECT with only the fields required. The conditions
+    are joined with AND, the ones with OR are wrapped by parenthesis to
+    keep the OR on its own condition.
+    """
+    where = ["resourceType = '{}'".format(resource_type)]
+    for c in conditions:
+        if ' OR ' in c.upper():
+            c = "({})".format(c)
+        where.append(c)
+    return "SELECT {} WHERE {}".format(
+        ", ".join(fields),
+        " AND ".join(where)
+    )
+
+
+def query_since(query, since):
+    """
+    Add the condition of the capture time (ISO format) to the query, the
+    conditions of the query are wrapped by parenthesis to keep its OR.
+    """
+    match = re.search(r"\sWHERE\s", query, flags=re.IGNORECASE)
+    condition = "configurationItemCaptureTime >= '{}'".format(since)
+    if match is None:
+        return "{} WHERE {}".format(query, condition)
+    return "{} WHERE ({}) AND {}".format(query[:match.start()], query[match.end():], condition)
+
+
+defaults = {
+    # only the fields used by the tagging rules of instances and volumes
+    "query_instances": build_Config_query(
+        'AWS::EC2::Instance',
+        [
+            "resourceId",
+            "configuration.blockDeviceMappings",
+            "configurationItemCaptureTime",
+            "tags"
+        ],
+        ["configuration.state.name IN ('running', 'stopped')"]
+    ),
+    # volumes changed since the checkpoint, see query_since()
+    "query_volumes": build_Config_query(
+        'AWS::EC2::Volume',
+        ["resourceId", "configurationItemCaptureTime"]
+    ),
+    "query_vpcs": build_Config_query(
+        'AWS::EC2::VPC',
+        ["resourceId", "tags"]
+    ),
+    # max page size of select_resource_config
+    "query_limit": 100
 }
 
+# Kept across warm invocations, see TTLCache.
+vpc_cache = TTLCache(
+    size=int(os.getenv("CACHE_VPC_SIZE", 256)),
+    ttl=int(os.getenv("CACHE_VPC_TTL", 3600))
+)
+instance_cache = TTLCache(
+    size=int(os.getenv("CACHE_INSTANCE_SIZE", 1024)),
+    ttl=int(os.getenv("CACHE_INSTANCE_TTL", 300))
+)
+
+# Same tuning to all clients: the connection pool must fit the threads
+# of the scheduler.
+client_config = Config(
+    max_pool_connections=int(os.getenv("CLIENT_MAX_POOL_CONNECTIONS", 32)),
+    connect_timeout=int(os.getenv("CLIENT_CONNECT_TIMEOUT", 5)),
+    read_timeout=int(os.getenv("CLIENT_READ_TIMEOUT", 60)),
+    retries={
+        "mode": os.getenv("CLIENT_RETRY_MODE", "standard"),
+        "max_attempts": int(os.getenv("CLIENT_MAX_ATTEMPTS", 3))
+    },
+    tcp_keepalive=os.getenv("CLIENT_TCP_KEEPALIVE", 'true').lower() in ['true', '1', 'yes']
+)
+# The clients called through the scheduler (see AWS.call) make one attempt
+# per call, the retries are made by the scheduler to adjust the concurrency
+# on each throttling. The others (sts, s3, sqs, lambda) keep the retries.
+scheduled_clients = ["ec2", "config", "cloudwatch", "resourcegroupstaggingapi"]
+scheduled_client_config = client_config.merge(Config(
+    retries={
+        "mode": os.getenv("CLIENT_RETRY_MODE", "standard"),
+        "total_max_attempts": int(os.getenv("SCHEDULED_CLIENT_MAX_ATTEMPTS", 1))
+    }
+))
+
+# Sessions and clients are created on first use and shared by all AWS
+# objects of the process (and warm invocations), keeping the connections:
+# {(region, role): (expiration, session)}
+# {(region, role, service): (expiration, client)}
+sessions_pool = {}
+clients_pool = {}
+clients_lock = threading.Lock()
+
+
+def is_expired(expiration):
+    if expiration is None:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expiration - datetime.timedelta(minutes=5) <= now
+
+
+def get_session(region=None, role_arn=None):
+    """
+    Get the session from the process pool, using the default credentials
+    or the assumed role when defined. Sessions are not thread-safe, it
+    must be called holding clients_lock.
+    Returns the session and the expiration of the credentials.
+    """
+    key = (region, role_arn)
+    try:
+        expiration, session = sessions_pool[key]
+        if not is_expired(expiration):
+            return session, expiration
+    except KeyError:
+        pass
+
+    if not role_arn:
+        session, expiration = boto3.Session(region_name=region), None
+    else:
+        sts = get_session(region)[0].client('sts', config=client_config)
+        creds = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName="aws-resource-tagger"
+        )["Credentials"]
+        session = boto3.Session(
+            aws_access_key_id=creds["AccessKeyId"],
+            aws_secret_access_key=creds["SecretAccessKey"],
+            aws_session_token=creds["SessionToken"],
+            region_name=region
+        )
+        expiration = creds["Expiration"]
+
+    sessions_pool[key] = (expiration, session)
+    return session, expiration
+
+
+def get_client(name, region=None, role_arn=None):
+    """
+    Get the client from the process pool, it will be created
+    on the first use (or when the assumed role is expired).
+    """
+    key = (region, role_arn, name)
+    with clients_lock:
+        try:
+            expiration, client = clients_pool[key]
+            if not is_expired(expiration):
+                return client
+        except KeyError:
+            pass
+
+        session, expiration = get_session(region, role_arn)
+        config = scheduled_client_config if name in scheduled_clients else client_config
+        client = session.client(name, region_name=region, config=config)
+        clients_pool[key] = (expiration, client)
+
+    return client
+
 
 class AWS(object):
-    def __init__(self):
-        self.clients = {}
+    def __init__(self, region=None, role_arn=None):
+        self.region = region
+        self.role_arn = role_arn
         self.config_queries = {}
 
         self.metric_namespace = "aws_resource_tagger"
         self.metrics_data = []
+        self.metrics_batch_size = 1000
+        self.metrics_emf = False
+        self.run_metrics = RunMetrics()
+        self.scheduler = get_scheduler(region, role_arn)
 
         self.setup()
     
     def setup(self):
         self.metrics_data.clear()
 
-        self.clients["ec2"] = config = boto3.client('ec2')
-        self.clients["config"] = config = boto3.client('config')
-        self.clients["cloudwatch"] = config = boto3.client('cloudwatch')
+        # Max metrics per put_metric_data call
+        self.metrics_batch_size = int(os.getenv("METRICS_BATCH_SIZE", 1000))
+        # Write metrics on CloudWatch Embedded Metric Format (log) instead of API calls
+        self.metrics_emf = os.getenv("METRICS_EMF", 'false').lower() in ['true', '1', 'yes']
 
         self.config_queries["instances"] = os.getenv("CONFIG_QUERY_INSTANCES", defaults["query_instances"])
+        self.config_queries["volumes"] = defaults["query_volumes"]
+
+    def client(self, name):
+        return get_client(name, self.region, self.role_arn)
+
+    def call(self, name, operation, **kwargs):
+        """
+        Call the client operation through the scheduler of the target (retry on
+        throttling), recording each attempt on run_metrics.
+        """
+        fn = getattr(self.client(name), operation)
 
+        def attempt(**kwargs):
+            started = time.perf_counter()
+            throttled = False
+            try:
+                return fn(**kwargs)
+            except Exception as e:
+                throttled = is_throttling(e)
+                raise
+            finally:
+                self.run_metrics.add_call(operation, time.perf_counter() - started, throttled)
+
+        self.run_metrics.add_request(operation)
+        return self.scheduler.call(attempt, **kwargs)
+
+    @profiling.timed
     def run_Config_query(self, query):
-        response = []
-        response.clear()
-        page = ''
-        next_page = True
-        while next_page:
-            if page == '':
-                resp = self.clients["config"].select_resource_config(Expression=query)
-            else:
-                resp = self.clients["config"].select_resource_config(Expression=query, NextToken=page)
+        return list(self.iter_Config_query(query))
 
-            if 'NextToken' in resp:
-                page = resp["NextToken"]
+    @profiling.timed
+    def iter_Config_query(self, query):
+        """
+        Generator of the parsed results of a Config query, the pages
+        are requested as the results are consumed.
+        """
+        for _, results in self.iter_Config_pages(query):
+            for r in results:
+                yield r
+
+    def iter_Config_pages(self, query, page=None):
+        """
+        Generator of (token, results) of each page of a Config query, see
+        iter_volume_pages() (None is the first page).
+        """
+        while True:
+            if page is None:
+                resp = self.call("config", "select_resource_config",
+                    Expression=query, Limit=defaults["query_limit"])
             else:
-                next_page = False
+                resp = self.call("config", "select_resource_config",
+                    Expression=query, Limit=defaults["query_limit"], NextToken=page)
 
-            for r in resp['Results']:
-                response.append(json.loads(r))
+            yield page, [json.loads(r) for r in resp['Results']]
 
-        return response
+            page = resp.get("NextToken")
+            if not page:
+                return
 
     def get_instances(self):
         return self.run_Config_query(
             self.config_queries["instances"]
         )
 
+    def iter_instances(self, since=None):
+        """
+        Generator of instances from Config, only the instances changed
+        since the capture time (ISO format) when it's defined.
+        """
+        query = self.config_queries["instances"]
+        if since:
+            query = query_since(query, since)
+        return self.iter_Config_query(query)
+
+    def iter_volume_pages_since(self, since, page=None, filters=None):
+        """
+        Generator of (token, volumes, capture_times) of the volumes changed
+        on Config since the capture time: each page of the Config query is
+        described by IDs (with the filters), the token is of the Config page.
+        """
+        query = query_since(self.config_queries["volumes"], since)
+        for token, results in self.iter_Config_pages(query, page):
+            volume_ids = [r["resourceId"] for r in results]
+            volumes = list(self.iter_volumes_by_ids(volume_ids, filters=filters))
+            yield token, volumes, [r.get("configurationItemCaptureTime") for r in results]
+
     def get_instance_tags_Config(self, instance_id):
         """
         AWS Config has delay to ingest resources, then events
@@ -79,15 +292,11 @@ class AWS(object):
         Therefore, to retrieve NEW resources, is not a good idea to
         use AWS Config.
          """
-        query = """
-            SELECT
-                resourceId,
-                tags,
-                relationships
-            WHERE
-                resourceType = 'AWS::EC2::Instance'
-                and resourceId = '{}'
-        """.format(instance_id)
+        query = build_Config_query(
+            'AWS::EC2::Instance',
+            ["resourceId", "tags", "relationships"],
+            ["resourceId = '{}'".format(instance_id)]
+        )
         return self.run_Config_query(query)
 
     def get_instance_tags_api(self, instance_id):
@@ -96,10 +305,12 @@ class AWS(object):
         Understanding that instance_id is unique for whole
         AWS resources, only the dictionary will be returned.
         """
-        instance_resp = {}
-        instance_resp.clear()
+        instance_resp = instance_cache.get(self.cache_key(instance_id), {})
+        if instance_resp:
+            return instance_resp
+
         try:
-            resp = self.clients["ec2"].describe_instances(
+            resp = self.call("ec2", "describe_instances",
                 InstanceIds=[instance_id]
             )
             if 'Reservations' not in resp:
@@ -111,97 +322,347 @@ class AWS(object):
             if len(resp["Reservations"][0]['Instances']) <= 0:
                 return instance_resp
 
-            instance = resp["Reservations"][0]['Instances'][0]
-            if 'Tags' not in instance:
-                tags = []
-            else:
-                tags = instance["Tags"]
-
-            dm = instance["BlockDeviceMappings"] or []
-            try:
-                vpc_id = instance["VpcId"] or ''
-            except KeyError:
-                vpc_id = ''
-                pass
-
-            instance_resp = {
-                "InstanceId": instance["InstanceId"],
-                "Tags": tags,
-                "BlockDeviceMappings": dm,
-                "VpcId": vpc_id
-            }
+            instance_resp = self.parse_instance(
+                resp["Reservations"][0]['Instances'][0]
+            )
+            instance_cache.set(self.cache_key(instance_id), instance_resp)
         except Exception as e:
             raise
 
         return instance_resp
 
+    @profiling.timed
+    def get_instances_tags_api(self, instance_ids, batch_size=100):
+        """
+        Get many instances from EC2:Instance API, with one
+        describe_instances call for each batch_size IDs.
+        Returns a dict of {InstanceId: instance}. Note that one invalid
+        ID fails the whole describe_instances call.
+        """
+        instances = {}
+        missing = []
+        for instance_id in instance_ids:
+            instance = instance_cache.get(self.cache_key(instance_id))
+            if instance:
+                instances[instance_id] = instance
+            else:
+                missing.append(instance_id)
+
+        for chunk in utils.chunks(missing, batch_size):
+            resp = self.call("ec2", "describe_instances",
+                InstanceIds=chunk
+            )
+            for reservation in resp.get("Reservations", []):
+                for instance in reservation["Instances"]:
+                    instance = self.parse_instance(instance)
+                    instance_cache.set(self.cache_key(instance["InstanceId"]), instance)
+                    instances[instance["InstanceId"]] = instance
+
+        return instances
+
+    def parse_instance(self, instance):
+        if 'Tags' not in instance:
+            tags = []
+        else:
+            tags = instance["Tags"]
+
+        dm = instance["BlockDeviceMappings"] or []
+        try:
+            vpc_id = instance["VpcId"] or ''
+        except KeyError:
+            vpc_id = ''
+            pass
+
+        return {
+            "InstanceId": instance["InstanceId"],
+            "Tags": tags,
+            "BlockDeviceMappings": dm,
+            "VpcId": vpc_id
+        }
+
+    def parse_volume(self, volume):
+        tags = []
+        if 'Tags' in volume:
+            tags = volume["Tags"]
+
+        at = []
+        if len(volume["Attachments"]) > 0:
+            at = volume["Attachments"][0]
+
+        return {
+            "VolumeId": volume["VolumeId"],
+            "Tags": tags,
+            "Attachments": at
+        }
+
     def get_volume_tags_api(self, resource_id):
         """
         Get Volumes directly from EC2:Volume API.
         Understanding that VolumeId is unique for whole
         AWS resources, only the dictionary will be returned.
         """
-        resource_resp = {}
-        resource_resp.clear()
-        try:
-            resp = self.clients["ec2"].describe_volumes(
-                VolumeIds=[resource_id]
+        resp = self.call("ec2", "describe_volumes",
+            VolumeIds=[resource_id]
+        )
+        if len(resp.get("Volumes", [])) <= 0:
+            return {}
+
+        return self.parse_volume(resp["Volumes"][0])
+
+    @profiling.timed
+    def get_volumes_tags_api(self, volume_ids, batch_size=200):
+        """
+        Same of get_volume_tags_api() to many volumes, one
+        describe_volumes call per batch_size IDs. Returns a dict
+        of {VolumeId: volume}, the volumes not found are missing.
+        """
+        volumes = {}
+        for volume in self.iter_volumes_by_ids(volume_ids, batch_size):
+            volumes[volume["VolumeId"]] = self.parse_volume(volume)
+        return volumes
+
+    @profiling.timed
+    def get_vpc_tags(self, vpc_id):
+        """
+        VPC tags rarely changes, the result is cached (when found)
+        to avoid a Config query on each event.
+        """
+        vpc = vpc_cache.get(self.cache_key(vpc_id))
+        if vpc:
+            return vpc
+
+        query = build_Config_query(
+            'AWS::EC2::VPC',
+            ["resourceId", "tags"],
+            ["resourceId = '{}'".format(vpc_id)]
+        )
+        vpc = self.run_Config_query(query)
+        if len(vpc) > 0:
+            vpc_cache.set(self.cache_key(vpc_id), vpc)
+        return vpc
+
+    @profiling.timed
+    def load_vpcs(self, vpc_ids=None):
+        """
+        Load the tags of the VPCs to the cache with one query, cheaper
+        than one query per VPC when processing many instances. Only the
+        vpc_ids not cached are queried (all VPCs when not defined).
+        """
+        query = defaults["query_vpcs"]
+        if vpc_ids is not None:
+            vpc_ids = sorted([v for v in set(vpc_ids) if v and not vpc_cache.get(self.cache_key(v))])
+            if len(vpc_ids) <= 0:
+                return []
+            query = build_Config_query(
+                'AWS::EC2::VPC',
+                ["resourceId", "tags"],
+                ["resourceId IN ({})".format(", ".join(["'{}'".format(v) for v in vpc_ids]))]
             )
-            if 'Volumes' not in resp:
-                return resource_resp
+        vpcs = self.run_Config_query(query)
+        for vpc in vpcs:
+            vpc_cache.set(self.cache_key(vpc["resourceId"]), [vpc])
+        return vpcs
 
-            if len(resp["Volumes"]) <= 0:
-                return resource_resp
+    def cache_key(self, resource_id):
+        """Resource IDs are unique by account and region."""
+        return (self.region, self.role_arn, resource_id)
 
-            resource = resp["Volumes"][0]
-            tags = []
-            if 'Tags' in resource:
-                tags = resource["Tags"]
-
-            at = []
-            if len(resource["Attachments"]) > 0:
-                at = resource["Attachments"][0]
-
-            resource_resp = {
-                "VolumeId": resource["VolumeId"],
-                "Tags": tags,
-                "Attachments": at
-            }
-        except Exception as e:
-            raise
+    def invalidate_cache(self, resource_id=None):
+        """
+        Invalidate cached lookups of resource_id (e.g. after tagging it),
+        or the whole cache when it's not defined.
+        """
+        if resource_id is None:
+            vpc_cache.invalidate()
+            instance_cache.invalidate()
+            return
+        vpc_cache.invalidate(self.cache_key(resource_id))
+        instance_cache.invalidate(self.cache_key(resource_id))
 
-        return resource_resp
+    def cache_stats(self):
+        return {
+            "vpc": vpc_cache.stats(),
+            "instance": instance_cache.stats()
+        }
 
-    def get_vpc_tags(self, vpc_id):
-        query = """
-            SELECT
-                resourceId,
-                tags
-            WHERE
-                resourceType = 'AWS::EC2::VPC'
-                AND resourceId = '{}'
-        """.format(vpc_id)
-        return self.run_Config_query(query)
+    def get_volumes(self, filters=None, max_results=None):
+        return dict([(volume['VolumeId'], volume) for volume in self.iter_volumes(filters, max_results)])
 
-    def get_volumes(self):
-        volumes = {}
-        volumes.clear()
-        for response in self.clients["ec2"].get_paginator('describe_volumes').paginate():
-            volumes.update([(volume['VolumeId'], volume) for volume in response['Volumes']])
-        
-        return volumes
+    def iter_volumes(self, filters=None, max_results=None):
+        """
+        Generator of volumes, one describe_volumes page at a time. The
+        filters are applied by EC2 (e.g. attachment.status), max_results
+        is the page size (5 to 500, all volumes when not defined).
+        """
+        for _, volumes in self.iter_volume_pages(filters=filters, max_results=max_results):
+            for volume in volumes:
+                yield volume
+
+    @profiling.timed
+    def iter_volume_pages(self, page=None, filters=None, max_results=None):
+        """
+        Generator of (token, volumes) of each describe_volumes page,
+        starting on the page token. The token can be used to request
+        the page again (None is the first page).
+        """
+        while True:
+            kwargs = {}
+            if filters:
+                kwargs["Filters"] = filters
+            if max_results:
+                kwargs["MaxResults"] = max_results
+            if page is not None:
+                kwargs["NextToken"] = page
+            with self.run_metrics.timer("volume_load"):
+                response = self.call("ec2", "describe_volumes", **kwargs)
+
+            yield page, response['Volumes']
+
+            page = response.get('NextToken')
+            if not page:
+                return
+
+    def iter_volumes_by_ids(self, volume_ids, batch_size=200, filters=None):
+        """
+        Generator of the volumes with the IDs. Uses the filter volume-id,
+        the volumes not found (deleted) are ignored instead of failing
+        the call as VolumeIds does.
+        """
+        return self.iter_describe_by_ids("describe_volumes", "Volumes", "volume-id",
+                                         volume_ids, batch_size, filters=filters)
+
+    @profiling.timed
+    def iter_describe_by_ids(self, operation, result_key, filter_name, ids, batch_size=200, filters=None, **kwargs):
+        """
+        Generator of the EC2 resources with the IDs, filtered by
+        filter_name (e.g. describe_snapshots, Snapshots, snapshot-id)
+        and the filters.
+        """
+        for chunk in utils.chunks(ids, batch_size):
+            page = None
+            while True:
+                params = dict(kwargs, Filters=[{"Name": filter_name, "Values": chunk}] + (filters or []))
+                if page is not None:
+                    params["NextToken"] = page
+                response = self.call("ec2", operation, **params)
+
+                for resource in response[result_key]:
+                    yield resource
+
+                page = response.get('NextToken')
+                if not page:
+                    break
+
+    def iter_snapshots(self):
+        """Generator of the snapshots owned by the account, one page at a time."""
+        for _, snapshots in self.iter_snapshot_pages():
+            for snapshot in snapshots:
+                yield snapshot
+
+    @profiling.timed
+    def iter_snapshot_pages(self, page=None):
+        """Generator of (token, snapshots) of each page, see iter_volume_pages() """
+        while True:
+            kwargs = {"OwnerIds": ['self'], "MaxResults": 1000}
+            if page is not None:
+                kwargs["NextToken"] = page
+            response = self.call("ec2", "describe_snapshots", **kwargs)
+
+            yield page, response['Snapshots']
+
+            page = response.get('NextToken')
+            if not page:
+                return
+
+    @profiling.timed
+    def iter_tagged_resources(self, resource_types):
+        """
+        Generator of the resources of the types (e.g. ec2:volume) from
+        the Resource Groups Tagging API, {ResourceARN, Tags}, in one
+        stream. Only resources that have (or had) tags are returned.
+        """
+        page = ''
+        while True:
+            response = self.call("resourcegroupstaggingapi", "get_resources",
+                ResourceTypeFilters=resource_types,
+                ResourcesPerPage=100,
+                PaginationToken=page
+            )
+
+            for resource in response['ResourceTagMappingList']:
+                yield resource
+
+            page = response.get('PaginationToken')
+            if not page:
+                return
+
+    @profiling.timed
+    def tag_resources(self, resource_arns, tags):
+        """
+        Tag up to 20 resources of any type with the Resource Groups
+        Tagging API. Fails when any resource was not tagged.
+        """
+        response = self.call("resourcegroupstaggingapi", "tag_resources",
+            ResourceARNList=resource_arns,
+            Tags=utils.tag_list_to_dict(tags)
+        )
+        failed = response.get("FailedResourcesMap") or {}
+        if failed:
+            raise Exception("Failed to tag {} resources: {}".format(len(failed), failed))
+        return response
 
     def add_metrics(self, data={}):
+        dimensions = data["dimensions"]
+        if isinstance(dimensions, dict):
+            dimensions = [dimensions]
         self.metrics_data.append({
             "MetricName": data["name"],
-            "Dimensions": [data["dimensions"]],
+            "Dimensions": dimensions,
             "Value": data["value"],
-            "Unit": "Count"
+            "Unit": data.get("unit", "Count")
         })
 
     def push_metrics(self):
-        self.clients["cloudwatch"].put_metric_data(
-            Namespace=self.metric_namespace,
-            MetricData=self.metrics_data
-        )
+        if self.metrics_emf:
+            self.print_metrics_emf()
+            self.metrics_data.clear()
+            return
+
+        for chunk in utils.chunks(self.metrics_data, self.metrics_batch_size):
+            self.call("cloudwatch", "put_metric_data",
+                Namespace=self.metric_namespace,
+                MetricData=chunk
+            )
         self.metrics_data.clear()
+
+    def print_metrics_emf(self):
+        """
+        Print the metrics on CloudWatch Embedded Metric Format, one log
+        line per set of dimensions (up to 100 distinct metrics each).
+        """
+        lines = {}
+        timestamp = int(time.time() * 1000)
+        for m in self.metrics_data:
+            key = tuple([(d["Name"], d["Value"]) for d in m["Dimensions"]])
+            line = lines.get(key)
+            if line is None or m["MetricName"] in line \
+                    or len(line["_aws"]["CloudWatchMetrics"][0]["Metrics"]) >= 100:
+                if line is not None:
+                    print(json.dumps(line))
+                line = lines[key] = dict(key)
+                line["_aws"] = {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.metric_namespace,
+                        "Dimensions": [[d[0] for d in key]],
+                        "Metrics": []
+                    }]
+                }
+            line[m["MetricName"]] = m["Value"]
+            line["_aws"]["CloudWatchMetrics"][0]["Metrics"].append({
+                "Name": m["MetricName"],
+                "Unit": m["Unit"]
+            })
+
+        for line in lines.values():
+            print(json.dumps(line))
@@ -0,0 +1,363 @@
+"""
+Benchmark of the discovery and event paths with a synthetic fleet.
+
+The AWS clients are replaced by in-memory stand-ins (no network), so
+the results are comparable between changes:
+
+    python benchmark.py --instances 5000 --output bench.json
+    python benchmark.py --instances 5000 --compare bench.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class Fleet(object):
+    """Synthetic inventory of instances, volumes, snapshots and VPCs."""
+    def __init__(self, instances=1000, volumes_per_instance=(1, 4), vpcs=20,
+                 tag_cardinality=50, tagged_ratio=0.5, unattached_ratio=0.05,
+                 snapshot_ratio=0.3, seed=42):
+        rnd = random.Random(seed)
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.vpcs = {}
+        # Config capture time of the changed resources, see changed()
+        self.capture_times = {}
+
+        for n in range(vpcs):
+            self.vpcs["vpc-{:08x}".format(n)] = {
+                "team": "team-{}".format(n % 5),
+                "env": ["prod", "staging", "dev"][n % 3],
+            }
+        vpc_ids = sorted(self.vpcs)
+
+        for n in range(instances):
+            instance_id = "i-{:017x}".format(n)
+            cluster = rnd.randrange(tag_cardinality)
+            devices = []
+            for d in range(rnd.randint(*volumes_per_instance)):
+                volume_id = "vol-{:08x}{:02x}".format(n, d)
+                device = "/dev/sd{}".format("abcdefghijklmnop"[d % 16])
+                devices.append({"DeviceName": device, "Ebs": {"VolumeId": volume_id}})
+                self.add_volume(rnd, volume_id, instance_id, device, tagged_ratio, snapshot_ratio)
+
+            tags = [
+                {"Key": "Name", "Value": "cluster{}-app{}-use1-{}".format(cluster, cluster % 7, n % 3)},
+                {"Key": "team", "Value": "team-{}".format(cluster % 5)},
+            ]
+            if rnd.random() < 0.5:
+                tags.append({"Key": "role", "Value": "app{}".format(cluster % 7)})
+            self.instances[instance_id] = {
+                "InstanceId": instance_id,
+                "VpcId": vpc_ids[n % len(vpc_ids)],
+                "BlockDeviceMappings": devices,
+                "Tags": tags,
+            }
+
+        for n in range(int(len(self.volumes) * unattached_ratio)):
+            volume_id = "vol-unattached{:06x}".format(n)
+            self.add_volume(rnd, volume_id, None, None, 0, snapshot_ratio)
+
+    def changed(self, resource_id, capture_time):
+        """Record a change on Config (configurationItemCaptureTime) """
+        self.capture_times[resource_id] = capture_time
+
+    def capture_time(self, resource_id):
+        return self.capture_times.get(resource_id, "2020-01-01T00:00:00.000Z")
+
+    def add_volume(self, rnd, volume_id, instance_id, device, tagged_ratio, snapshot_ratio):
+        snapshot_id = ''
+        if rnd.random() < snapshot_ratio:
+            snapshot_id = "snap-{}".format(volume_id[4:])
+            self.snapshots[snapshot_id] = {"SnapshotId": snapshot_id, "VolumeId": volume_id}
+        volume = {
+            "VolumeId": volume_id,
+            "SnapshotId": snapshot_id,
+            "AvailabilityZone": "us-east-1a",
+            "State": "in-use" if instance_id else "available",
+            "Attachments": [],
+        }
+        if instance_id:
+            volume["Attachments"].append({
+                "InstanceId": instance_id,
+                "Device": device,
+                "State": "attached",
+                "VolumeId": volume_id,
+            })
+        if rnd.random() < tagged_ratio:
+            volume["Tags"] = [{"Key": "Name", "Value": "tagged"}]
+        self.volumes[volume_id] = volume
+
+
+class StubClient(object):
+    """In-memory stand-in of a boto3 client, counting the calls by operation."""
+    def __init__(self, fleet, calls, latency=0):
+        self.fleet = fleet
+        self.calls = calls
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def record(self, operation, started):
+        with self.lock:
+            self.calls[operation]["count"] += 1
+            self.calls[operation]["time"] += time.perf_counter() - started
+
+    def __getattr__(self, operation):
+        if not hasattr(type(self), "op_" + operation):
+            raise AttributeError(operation)
+        method = getattr(self, "op_" + operation)
+
+        def call(**kwargs):
+            started = time.perf_counter()
+            if self.latency:
+                time.sleep(self.latency)
+            try:
+                return method(**kwargs)
+            finally:
+                self.record(operation, started)
+        return call
+
+    def page(self, items, key, token, size):
+        start = int(token or 0)
+        if not size:
+            return {key: items[start:]}
+        resp = {key: items[start:start + size]}
+        if start + size < len(items):
+            resp["NextToken"] = str(start + size)
+        return resp
+
+
+class StubEC2(StubClient):
+    FILTERS = {
+        "attachment.status": lambda v: [a["State"] for a in v["Attachments"]],
+        "attachment.instance-id": lambda v: [a["InstanceId"] for a in v["Attachments"]],
+        "availability-zone": lambda v: [v["AvailabilityZone"]],
+        "status": lambda v: [v["State"]],
+        "volume-id": lambda v: [v["VolumeId"]],
+    }
+
+    def op_describe_volumes(self, VolumeIds=None, Filters=[], MaxResults=None, NextToken=None):
+        # the filtered list is kept between the pages of the same request,
+        # the first page (no NextToken) filters the fleet again
+        key = json.dumps([VolumeIds, Filters])
+        if NextToken is None or getattr(self, "filtered", (None,))[0] != key:
+            ids = VolumeIds or ([f["Values"] for f in Filters if f["Name"] == "volume-id"] or [None])[0]
+            if ids:
+                volumes = [self.fleet.volumes[v] for v in ids if v in self.fleet.volumes]
+            else:
+                volumes = list(self.fleet.volumes.values())
+            for f in Filters:
+                get = self.FILTERS.get(f["Name"])
+                if get is not None:
+                    values = set(f["Values"])
+                    volumes = [v for v in volumes if values.intersection(get(v))]
+            self.filtered = (key, volumes)
+        return self.page(self.filtered[1], "Volumes", NextToken, MaxResults)
+
+    def op_describe_instances(self, InstanceIds=None, MaxResults=None, NextToken=None):
+        ids = InstanceIds or list(self.fleet.instances)
+        instances = [self.fleet.instances[i] for i in ids if i in self.fleet.instances]
+        return {"Reservations": [{"Instances": [i]} for i in instances]}
+
+    def op_describe_snapshots(self, OwnerIds=None, MaxResults=None, NextToken=None, **kwargs):
+        return self.page(list(self.fleet.snapshots.values()), "Snapshots", NextToken, MaxResults)
+
+    def op_create_tags(self, Resources, Tags):
+        for resource_id in Resources:
+            for inventory in [self.fleet.volumes, self.fleet.instances, self.fleet.snapshots]:
+                if resource_id in inventory:
+                    tags = dict([(t["Key"], t) for t in inventory[resource_id].get("Tags", [])])
+                    tags.update([(t["Key"], t) for t in Tags])
+                    inventory[resource_id]["Tags"] = list(tags.values())
+        return {}
+
+
+class StubConfig(StubClient):
+    def op_select_resource_config(self, Expression, Limit=None, NextToken=None):
+        resource_id = re.search(r"resourceId = '([^']+)'", Expression)
+        since = re.search(r"configurationItemCaptureTime >= '([^']+)'", Expression)
+        if "AWS::EC2::VPC" in Expression:
+            inventory, row = self.fleet.vpcs, self.vpc_row
+        elif "AWS::EC2::Volume" in Expression:
+            inventory, row = self.fleet.volumes, self.volume_row
+        else:
+            inventory, row = self.fleet.instances, self.instance_row
+        ids = [resource_id.group(1)] if resource_id else list(inventory)
+        ids = [i for i in ids if i in inventory]
+        if since:
+            ids = [i for i in ids if self.fleet.capture_time(i) >= since.group(1)]
+
+        resp = self.page(ids, "Results", NextToken, min(Limit or 100, 100))
+        resp["Results"] = [json.dumps(row(i)) for i in resp["Results"]]
+        return resp
+
+    def vpc_row(self, vpc_id):
+        return {
+            "resourceId": vpc_id,
+            "tags": [{"key": k, "value": v} for k, v in self.fleet.vpcs[vpc_id].items()]
+        }
+
+    def volume_row(self, volume_id):
+        return {
+            "resourceId": volume_id,
+            "configurationItemCaptureTime": self.fleet.capture_time(volume_id),
+        }
+
+    def instance_row(self, instance_id):
+        instance = self.fleet.instances[instance_id]
+        return {
+            "resourceId": instance["InstanceId"],
+            "configurationItemCaptureTime": self.fleet.capture_time(instance_id),
+            "configuration": {
+                "vpcId": instance["VpcId"],
+                "blockDeviceMappings": [{
+                    "deviceName": b["DeviceName"],
+                    "ebs": {"volumeId": b["Ebs"]["VolumeId"]}
+                } for b in instance["BlockDeviceMappings"]],
+            },
+            "tags": [{"key": t["Key"], "value": t["Value"]} for t in instance["Tags"]],
+        }
+
+
+class StubCloudWatch(StubClient):
+    def op_put_metric_data(self, Namespace, MetricData):
+        return {}
+
+
+def install_stubs(fleet, latency=0):
+    """Replace the clients of the process pool by the stand-ins."""
+    import aws
+    import debounce
+
+    calls = CallCounter()
+    aws.clients_pool.clear()
+    for name, cls in [("ec2", StubEC2), ("config", StubConfig), ("cloudwatch", StubCloudWatch)]:
+        aws.clients_pool[(None, None, name)] = (None, cls(fleet, calls, latency))
+    aws.vpc_cache.invalidate()
+    aws.instance_cache.invalidate()
+    # each scenario starts without the resources processed by the previous one
+    debounce.debouncer = None
+    return calls
+
+
+class CallCounter(dict):
+    def __missing__(self, operation):
+        self[operation] = {"count": 0, "time": 0.0}
+        return self[operation]
+
+
+def measure(name, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn()
+    wall_time = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scenario": name,
+        "wall_time_s": round(wall_time, 4),
+        "peak_memory_kb": round(peak / 1024.0, 1),
+    }
+
+
+def run_scenarios(args):
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("TAG_FILTER_KEYS_INSTANCE", "Name,team,role")
+    os.environ.setdefault("TAG_REQUIRED_KEYS_INSTANCE", "Name,team,role,env")
+    os.environ.setdefault("TAG_DEFAULT_COPY_KEY", "Name")
+    os.environ.setdefault("TAG_DEFAULT_COPY_SPLIT", "-,2")
+
+    import main
+
+    results = []
+    for scenario in args.scenarios:
+        fleet = Fleet(
+            instances=args.instances,
+            volumes_per_instance=(args.min_volumes, args.max_volumes),
+            vpcs=args.vpcs,
+            tag_cardinality=args.tag_cardinality,
+            tagged_ratio=args.tagged_ratio,
+            seed=args.seed,
+        )
+        calls = install_stubs(fleet, latency=args.latency / 1000.0)
+        events = [{"detail": {"instance-id": i}} for i in list(fleet.instances)[:args.events]]
+
+        if scenario == "discovery":
+            fn = main.discovery_apply
+        elif scenario == "events":
+            fn = lambda: [main.handler_event(e, None) for e in events]
+        elif scenario == "events_batch":
+            fn = lambda: main.handler_events(events, None)
+        else:
+            raise ValueError("Unknown scenario: {}".format(scenario))
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result = measure(scenario, fn)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        result.update({
+            "instances": len(fleet.instances),
+            "volumes": len(fleet.volumes),
+            "api_calls": sum([c["count"] for c in calls.values()]),
+            "api_calls_by_operation": dict([(op, c["count"]) for op, c in sorted(calls.items())]),
+            "api_time_by_operation_s": dict([(op, round(c["time"], 4)) for op, c in sorted(calls.items())]),
+        })
+        results.append(result)
+
+    return results
+
+
+def compare(results, baseline):
+    baseline = dict([(r["scenario"], r) for r in baseline])
+    for r in results:
+        b = baseline.get(r["scenario"])
+        if b is None:
+            continue
+        for key in ["wall_time_s", "peak_memory_kb", "api_calls"]:
+            delta = (r[key] - b[key]) / float(b[key] or 1) * 100
+            print("{:<14} {:<16} {:>12} -> {:>12} ({:+.1f}%)".format(
+                r["scenario"], key, b[key], r[key], delta))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AWS Resource Tagger benchmark.')
+    parser.add_argument('--instances', type=int, default=1000)
+    parser.add_argument('--min-volumes', type=int, default=1)
+    parser.add_argument('--max-volumes', type=int, default=4)
+    parser.add_argument('--vpcs', type=int, default=20)
+    parser.add_argument('--tag-cardinality', type=int, default=50,
+                        help='Number of distinct clusters (tag values)')
+    parser.add_argument('--tagged-ratio', type=float, default=0.5,
+                        help='Ratio of volumes already tagged')
+    parser.add_argument('--events', type=int, default=200,
+                        help='Number of events of the event scenarios')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Simulated latency of each API call (ms)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scenarios', nargs='+', default=["discovery", "events", "events_batch"])
+    parser.add_argument('--output', help='Write the results (JSON) to the file')
+    parser.add_argument('--compare', help='Compare with the results (JSON) of the file')
+
+    args = parser.parse_args()
+
+    results = run_scenarios(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,56 @@
+import os
+import time
+
+from cache import TTLCache
+import state
+
+
+class Debouncer(object):
+    """
+    Coalesce the events of the same resource: a resource processed in
+    the last window seconds is skipped. The keys are kept on a TTL cache
+    (in memory, across warm invocations) and optionally on a state store
+    shared by the concurrent executions.
+    """
+    def __init__(self, window=300, size=10000, store=None):
+        self.window = window
+        self.store = store
+        self.recent = TTLCache(size=size, ttl=window)
+
+    def seen(self, key):
+        if self.window <= 0:
+            return False
+        if self.recent.get(key):
+            return True
+        if self.store is None:
+            return False
+
+        processed_at = self.store.get(key)
+        if processed_at and time.time() - processed_at < self.window:
+            self.recent.set(key, True)
+            return True
+        return False
+
+    def mark(self, key):
+        if self.window <= 0:
+            return
+        self.recent.set(key, True)
+        if self.store is not None:
+            self.store.set(key, time.time(), ttl=self.window)
+
+
+debouncer = None
+
+
+def get_debouncer():
+    """
+    Debouncer defined by env vars DEBOUNCE_WINDOW (seconds, 0 to disable)
+    and DEBOUNCE_STORE (see state.get_store()), kept across invocations.
+    """
+    global debouncer
+    if debouncer is None:
+        debouncer = Debouncer(
+            window=int(os.getenv("DEBOUNCE_WINDOW", 300)),
+            store=state.get_store(os.getenv("DEBOUNCE_STORE")) if os.getenv("DEBOUNCE_STORE") else None
+        )
+    return debouncer
@@ -0,0 +1,71 @@
+import sys
+
+
+class TagSets(object):
+    """
+    Interned tag sets: resources with the same tags (e.g. every volume
+    of an autoscaling group) share the same dict, which must not be
+    changed. Keys and values are interned strings.
+    """
+    def __init__(self):
+        self.tag_sets = {}
+
+    def get(self, tags):
+        key = tuple(sorted([(sys.intern(k), sys.intern(v)) for k, v in tags.items()]))
+        try:
+            return self.tag_sets[key]
+        except KeyError:
+            # setdefault is atomic, the inventory is loaded by two threads
+            return self.tag_sets.setdefault(key, dict(key))
+
+    def clear(self):
+        self.tag_sets.clear()
+
+    def __len__(self):
+        return len(self.tag_sets)
+
+
+class Instance(object):
+    """
+    Instance of the inventory. tags is None when the instance was
+    not found, volumes_ebs is {volume_id: device_name} and volumes
+    has the non EBS devices {device_name: mapping}.
+    """
+    __slots__ = ("tags", "volumes_ebs", "volumes")
+
+    def __init__(self, tags=None):
+        self.tags = tags
+        self.volumes_ebs = {}
+        self.volumes = {}
+
+    def __repr__(self):
+        return "Instance(tags={}, volumes_ebs={})".format(self.tags, self.volumes_ebs)
+
+
+class Volume(object):
+    """
+    Volume of the inventory with the tags inherited from the instance,
+    only the missing ones when the volume was tagged (enforce mode).
+    tags is the shared tag set of the instance when device is set, the
+    Name is suffixed by the device when written (see tags_to_apply).
+    """
+    __slots__ = ("snapshot_id", "instance_id", "attached", "tagged", "tags", "device", "error")
+
+    def __init__(self, snapshot_id=None):
+        self.snapshot_id = snapshot_id
+        self.instance_id = None
+        self.attached = False
+        self.tagged = False
+        self.tags = None
+        self.device = None
+        self.error = None
+
+    def tags_to_apply(self):
+        if self.device is None or not self.tags or 'Name' not in self.tags:
+            return self.tags
+        return dict(self.tags, Name="{} {}".format(self.tags["Name"], self.device))
+
+    def __repr__(self):
+        return "Volume(instance_id={}, attached={}, tags={}, device={}, error={})".format(
+            self.instance_id, self.attached, self.tags, self.device, self.error)
+
@@ -1,36 +1,310 @@
+import time
+INIT_START = time.perf_counter()
+
+import json
 import logging
 import os
+
+from aws import AWS, get_client
+import profiling
 from resources import Resources
+import state
 
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+INIT_DURATION = time.perf_counter() - INIT_START
+cold_start = True
+
+
+def log_startup(handler, started):
+    """
+    Print the time spent on module init (imports) and on the first
+    invocation of the process, to measure the cold start.
+    """
+    global cold_start
+    if not cold_start:
+        return
+    cold_start = False
+    print("Cold start [{}]: init {:.1f} ms, first invocation {:.1f} ms".format(
+        handler, INIT_DURATION * 1000, (time.perf_counter() - started) * 1000))
+
+
+def discovery_targets():
+    """
+    List of (region, role_arn) to run the discovery. Defined by env vars
+    DISCOVERY_REGIONS and DISCOVERY_ROLE_ARNS (comma separated), when
+    empty the default region and credentials are used.
+    """
+    regions = [r for r in os.getenv("DISCOVERY_REGIONS", '').split(',') if r] or [None]
+    roles = [r for r in os.getenv("DISCOVERY_ROLE_ARNS", '').split(',') if r] or [None]
+
+    return [(region, role) for role in roles for region in regions]
+
+
+def discovery_shards():
+    """
+    Continuation of each availability zone of the targets, to run the
+    discovery of volumes in parallel invocations (DISCOVERY_SHARDS=az).
+    Snapshots and other types are tagged by the first shard of each target.
+    """
+    shards = []
+    for region, role_arn in discovery_targets():
+        zones = AWS(region=region, role_arn=role_arn).call("ec2", "describe_availability_zones")
+        for idx, zone in enumerate(zones["AvailabilityZones"]):
+            shards.append({
+                "region": region,
+                "role_arn": role_arn,
+                "cursor": {
+                    "phase": "volumes",
+                    "token": None,
+                    "filters": [{"Name": "availability-zone", "Values": [zone["ZoneName"]]}],
+                    "all_phases": idx == 0
+                }
+            })
+    return shards
+
+
+def discovery_deadline(context):
+    """Time to stop the discovery, DISCOVERY_DEADLINE_MARGIN seconds before the timeout """
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    margin = float(os.getenv("DISCOVERY_DEADLINE_MARGIN", 5))
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - margin
 
-def discovery_apply():
-    resources = Resources()
+
+def invoke_discovery(context, continuation, invocation):
+    """Invoke the function (async) to continue the discovery """
+    max_invocations = int(os.getenv("DISCOVERY_MAX_INVOCATIONS", 50))
+    if invocation > max_invocations:
+        print("ERR - discovery not finished after {} invocations: {}".format(
+            max_invocations, json.dumps(continuation)))
+        return
+    print("Continuing discovery on invocation {}: {}".format(invocation, json.dumps(continuation)))
+    get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({"continuation": continuation, "invocation": invocation})
+    )
+
+
+@profiling.profiled("discovery_apply")
+def discovery_apply_target(region=None, role_arn=None, cursor=None, deadline=None):
+    resources = Resources(region=region, role_arn=role_arn)
+    resources.deadline = deadline
+
+    # Incremental discovery when the state store is defined. The checkpoint
+    # of a run continued by other invocations is kept on <key>/continuation
+    # until the last one finishes (the shards don't keep a checkpoint).
+    store = state.get_store()
+    checkpoint_key = resources.target() or 'default'
+    if cursor:
+        resources.set_cursor(cursor)
+        if store and cursor.get("checkpoint"):
+            resources.set_checkpoint(store.get(checkpoint_key + "/continuation"), continued=True)
+    elif store:
+        resources.set_checkpoint(store.get(checkpoint_key))
+
+    cursor = cursor or {}
+    all_phases = cursor.get("all_phases", True)
 
     #resources.apply_tags_instances()
-    resources.apply_tags_volumes()
+    if cursor.get("phase", "volumes") == "volumes":
+        resources.apply_tags_volumes()
+    if resources.next_cursor is None and all_phases and resources.tag_snapshots:
+        resources.apply_tags_snapshots()
+    if resources.next_cursor is None and all_phases and resources.tagging_api_types:
+        resources.apply_tags_resource_types()
+
+    if store and resources.full_run_at is not None:
+        if resources.next_cursor is None:
+            store.set(checkpoint_key, resources.get_checkpoint())
+        else:
+            store.set(checkpoint_key + "/continuation", resources.get_checkpoint())
+            resources.next_cursor["checkpoint"] = True
+
+    return resources
+
+
+def discovery_apply(deadline=None, continuation=None):
+    """
+    Run the discovery on the targets, or on the continuation of a previous
+    run (list of {region, role_arn, cursor}). Stops on the deadline and
+    returns the continuation of the targets not finished.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if continuation:
+        targets = [(c["region"], c["role_arn"], c["cursor"]) for c in continuation]
+    else:
+        targets = [(region, role_arn, None) for region, role_arn in discovery_targets()]
+    workers = min(int(os.getenv("DISCOVERY_WORKERS", 8)), len(targets))
 
-    resources.show_report()
-    resources.add_metrics()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(discovery_apply_target, region, role_arn, cursor, deadline): (region, role_arn)
+                   for region, role_arn, cursor in targets}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("ERR - discovery failed on target {}: {}".format(futures[future], e))
+
+    aws = AWS()
+    for resources in results:
+        resources.show_report()
+        resources.add_metrics(aws)
+
+    if len(targets) > 1:
+        print("Total targets: {} ({} failed)".format(len(targets), len(targets) - len(results)))
+        print("Total untagged volumes (all targets): {}".format(
+            sum([r.total_volumes() for r in results])))
+    aws.push_metrics()
+
+    return [{
+        "region": r.aws.region,
+        "role_arn": r.aws.role_arn,
+        "cursor": r.next_cursor
+    } for r in results if r.next_cursor is not None]
+
+
+def push_run_metrics(resources):
+    """
+    Metrics of the event handlers are written only on Embedded Metric
+    Format (METRICS_EMF), to not add an API call to each event.
+    """
+    if not resources.aws.metrics_emf:
+        return
+    for data in resources.aws.run_metrics.get_data():
+        resources.aws.add_metrics(data=data)
     resources.aws.push_metrics()
 
 
 def handler_discovery_apply(event, context):
-    main()
+    """
+    Scheduled discovery. Before the function timeout, the discovery is
+    stopped and continued by a new invocation with the continuation.
+    """
+    started = time.perf_counter()
+    event = event if isinstance(event, dict) else {}
+    continuation = event.get("continuation")
+
+    if continuation is None and os.getenv("DISCOVERY_SHARDS", '') == 'az':
+        continuation = discovery_shards()
+        if context is not None:
+            for shard in continuation:
+                invoke_discovery(context, [shard], 1)
+            return
 
+    continuation = discovery_apply(discovery_deadline(context), continuation)
+    if continuation:
+        invoke_discovery(context, continuation, event.get("invocation", 0) + 1)
+    log_startup("discovery_apply", started)
 
+
+@profiling.profiled("handler_event")
 def handler_event(event, context):
     """Handle CloudWatch Event rule."""
+    started = time.perf_counter()
     resources = Resources()
     try:
         resources.apply_tags_from_event(event)
     except Exception as e:
         print(e)
         raise
+    finally:
+        push_run_metrics(resources)
+        log_startup("handler_event", started)
+
+
+@profiling.profiled("handler_events")
+def handler_events(event, context):
+    """
+    Handle a batch of events: a SQS batch (Records) or a list of
+    CloudWatch Events. Returns the failed SQS messages to allow
+    partial batch retries (ReportBatchItemFailures).
+    """
+    started = time.perf_counter()
+    if isinstance(event, dict) and 'Records' in event:
+        records = event["Records"]
+    elif isinstance(event, list):
+        records = [{"messageId": str(idx), "body": e} for idx, e in enumerate(event)]
+    else:
+        records = [{"messageId": "0", "body": event}]
+
+    failures = []
+    events = []
+    ids = []
+    for record in records:
+        try:
+            body = record["body"]
+            events.append(json.loads(body) if isinstance(body, str) else body)
+            ids.append(record["messageId"])
+        except Exception as e:
+            print("ERR - invalid record {}: {}".format(record, e))
+            failures.append({"itemIdentifier": record.get("messageId")})
+
+    resources = Resources()
+    errors = resources.apply_tags_from_events(events)
+    for message_id, error in zip(ids, errors):
+        if error is not None:
+            failures.append({"itemIdentifier": message_id})
+
+    push_run_metrics(resources)
+    log_startup("handler_events", started)
+    return {"batchItemFailures": failures}
+
+
+@profiling.profiled("bulk_apply")
+def bulk_apply(lines, chunk_size=1000):
+    """
+    Tag the instances of the IDs (one per line of a file or stdin) and
+    their volumes, read in chunks of chunk_size IDs. Prints the progress
+    and a summary.
+    """
+    started = time.perf_counter()
+    resources = Resources()
+    run_metrics = resources.aws.run_metrics
+    summary = {"instances": 0, "errors": 0}
+
+    def apply(instance_ids):
+        messages = resources.apply_tags_instances_bulk(instance_ids)
+        errors = [m for m in messages if m.startswith("error")]
+        for m in errors:
+            print("ERR - {}".format(m))
+        summary["instances"] += len(instance_ids)
+        summary["errors"] += len(errors)
+        elapsed = time.perf_counter() - started
+        print("Processed {} instances in {:.1f}s ({:.1f} instances/s)".format(
+            summary["instances"], elapsed, summary["instances"] / elapsed))
+
+    chunk = []
+    chunk_ids = set()
+    for line in lines:
+        instance_id = line.strip()
+        if not instance_id or instance_id.startswith('#') or instance_id in chunk_ids:
+            continue
+        chunk.append(instance_id)
+        chunk_ids.add(instance_id)
+        if len(chunk) >= chunk_size:
+            apply(chunk)
+            chunk = []
+            chunk_ids = set()
+    if chunk:
+        apply(chunk)
+
+    elapsed = time.perf_counter() - started
+    summary.update({
+        "tagged": dict(run_metrics.tagged),
+        "api_calls": sum(run_metrics.calls.values()),
+        "seconds": round(elapsed, 1),
+        "instances_per_second": round(summary["instances"] / elapsed, 1) if elapsed else 0
+    })
+    print("Summary: {}".format(json.dumps(summary)))
+    push_run_metrics(resources)
+    return summary
 
 
 if __name__ == '__main__':
@@ -42,13 +316,28 @@ if __name__ == '__main__':
                     metavar="InstanceId", type=str,
                     help='Instance ID to tag. Eg: i-12345678')
 
+    parser.add_argument('-w', '--worker',
+                    metavar="QueueUrl", type=str, nargs='?', const='',
+                    help='Run as a worker, tagging the events of the queue '
+                         '(default: env WORKER_QUEUE). Eg: file:///tmp/events.jsonl')
+
+    parser.add_argument('-f', '--file',
+                    metavar="File", type=argparse.FileType('r'),
+                    help='File with the instance IDs to tag, one per line, '
+                         'or - to read from stdin')
+
     args = parser.parse_args()
 
-    if args.instance:
+    if args.file:
+        bulk_apply(args.file, chunk_size=int(os.getenv("BULK_CHUNK_SIZE", 1000)))
+    elif args.instance:
         handler_event({
             "detail": {
                 "instance-id": "{}".format(args.instance)
             }
         }, None)
+    elif args.worker is not None:
+        import worker
+        worker.run_worker(args.worker)
     else:
         print("Option not found, please use -h")
@@ -0,0 +1,83 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RunMetrics(object):
+    """
+    Instrumentation of a run: duration of each phase, API calls and
+    latencies by operation, throttles, retries and tagged resources.
+    Thread-safe, the tag writes and the targets run in parallel.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.requests = {}
+        self.calls = {}
+        self.latency = {}
+        self.throttles = {}
+        self.tagged = {}
+
+    def incr(self, counter, key, value=1):
+        with self.lock:
+            counter[key] = counter.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, phase):
+        """Accumulate the time spent on phase (phases are interleaved by the streaming)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr(self.phases, phase, time.perf_counter() - started)
+
+    def add_request(self, operation):
+        self.incr(self.requests, operation)
+
+    def add_call(self, operation, seconds, throttled=False):
+        """Each attempt of the request, including the retries."""
+        self.incr(self.calls, operation)
+        self.incr(self.latency, operation, seconds)
+        if throttled:
+            self.incr(self.throttles, operation)
+
+    def add_tagged(self, resource_type, count=1):
+        self.incr(self.tagged, resource_type, count)
+
+    def get_data(self, dimensions=[]):
+        """List of metrics data to AWS.add_metrics() """
+        data = []
+        with self.lock:
+            for phase, seconds in sorted(self.phases.items()):
+                data.append({
+                    "name": "phase_duration",
+                    "value": seconds * 1000,
+                    "unit": "Milliseconds",
+                    "dimensions": [{"Name": "phase", "Value": phase}] + dimensions
+                })
+            for operation, count in sorted(self.calls.items()):
+                dims = [{"Name": "operation", "Value": operation}] + dimensions
+                data.append({"name": "api_calls", "value": count, "dimensions": dims})
+                data.append({
+                    "name": "api_latency",
+                    "value": self.latency[operation] / count * 1000,
+                    "unit": "Milliseconds",
+                    "dimensions": dims
+                })
+                data.append({
+                    "name": "api_retries",
+                    "value": count - self.requests.get(operation, count),
+                    "dimensions": dims
+                })
+                data.append({
+                    "name": "api_throttles",
+                    "value": self.throttles.get(operation, 0),
+                    "dimensions": dims
+                })
+            for resource_type, count in sorted(self.tagged.items()):
+                data.append({
+                    "name": "tagged_resources",
+                    "value": count,
+                    "dimensions": [{"Name": "resource", "Value": resource_type}] + dimensions
+                })
+        return data
@@ -0,0 +1,167 @@
+"""
+Opt-in profiling of the invocations, enabled by env PROFILE (comma
+separated): cprofile, tracemalloc and timings (of the AWS helpers, see
+timed()). The env vars are read on import, when PROFILE is empty the
+functions are not wrapped.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import inspect
+import io
+import itertools
+import os
+import threading
+import time
+
+
+modes = [m.strip() for m in os.getenv("PROFILE", '').lower().split(',') if m.strip()]
+cprofile = 'cprofile' in modes
+allocations = 'tracemalloc' in modes
+timings = 'timings' in modes
+
+# Directory of the pstats and allocations files, the log when empty
+path = os.getenv("PROFILE_PATH", '')
+# Lines of the stats and allocations summaries
+top = int(os.getenv("PROFILE_TOP", 25))
+# Frames of the traceback stored by tracemalloc
+frames = int(os.getenv("PROFILE_FRAMES", 1))
+
+tracing_lock = threading.Lock()
+tracing = 0
+counter = itertools.count()
+
+
+def output(name, suffix, text):
+    """Write text to a file of PROFILE_PATH, or print it """
+    if not path:
+        print(">> Profile [{}] {}:\n{}".format(name, suffix, text))
+        return
+    filename = os.path.join(path, "{}-{}.txt".format(name, suffix))
+    with open(filename, 'w') as f:
+        f.write(text)
+    print("Profile [{}] {} written to {}".format(name, suffix, filename))
+
+
+def start_tracing():
+    """tracemalloc is global, it's stopped by the last profile running """
+    import tracemalloc
+
+    global tracing
+    with tracing_lock:
+        if tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        tracing += 1
+
+
+def stop_tracing(name):
+    import tracemalloc
+
+    global tracing
+    with tracing_lock:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracing -= 1
+        if tracing == 0:
+            tracemalloc.stop()
+
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "*/cProfile.py"),
+        tracemalloc.Filter(False, "*/profile.py"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ])
+    stats = snapshot.statistics('traceback' if frames > 1 else 'lineno')
+    lines = ["Traced memory: current {:.1f} KiB, peak {:.1f} KiB".format(current / 1024, peak / 1024)]
+    for stat in stats[:top]:
+        lines.append(str(stat))
+        if frames > 1:
+            lines += ["    " + l for l in stat.traceback.format()]
+    output(name, "allocations", "\n".join(lines))
+
+
+@contextmanager
+def profile(name):
+    """Profile the block with cProfile and/or tracemalloc, see PROFILE """
+    name = "{}-{}-{}".format(name, time.strftime("%Y%m%dT%H%M%S"), next(counter))
+    profiler = None
+    if cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if allocations:
+        start_tracing()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+: one profiler at a time (all threads)
+            print("ERR - profile [{}] not started: {}".format(name, e))
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if allocations:
+            stop_tracing(name)
+        if profiler is not None:
+            if path:
+                filename = os.path.join(path, "{}.pstats".format(name))
+                profiler.dump_stats(filename)
+                print("Profile [{}] pstats written to {}".format(name, filename))
+            else:
+                import pstats
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+                output(name, "stats", stream.getvalue())
+
+
+def profiled(name):
+    """
+    Decorator to profile each call of the function (see profile()), the
+    function is returned as is when cprofile and tracemalloc are disabled.
+    """
+    def decorator(fn):
+        if not cprofile and not allocations:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed(fn):
+    """
+    Decorator of the AWS methods, the time of each call is added to the
+    phase aws.<method> of self.run_metrics (the time of each page for the
+    generators). The method is returned as is when timings is disabled.
+    """
+    if not timings:
+        return fn
+
+    phase = "aws.{}".format(fn.__name__)
+    if inspect.isgeneratorfunction(fn):
+        @wraps(fn)
+        def generator(self, *args, **kwargs):
+            items = fn(self, *args, **kwargs)
+            try:
+                while True:
+                    with self.run_metrics.timer(phase):
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                items.close()
+        return generator
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self.run_metrics.timer(phase):
+            return fn(self, *args, **kwargs)
+    return wrapper
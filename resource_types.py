@@ -0,0 +1,107 @@
+"""
+Resource types tagged through the Resource Groups Tagging API. Each type
+inherits the missing tags from its parent (e.g. volume -> instance), the
+relation is described only for the resources missing required tags.
+"""
+
+
+class ResourceType(object):
+    """
+    - name: resource type on the ARN (arn:aws:<service>:...:<name>/<id>)
+    - parent: name of the type which the tags are inherited from
+    - parents: function(aws, ids) generator of (id, parent_id, name_suffix)
+    - rule: 'inherit' the filtered tags of the parent, or 'instance'
+      (see rules.TagRules.instance_tags(), the parent is the VPC)
+    """
+    def __init__(self, name, service="ec2", parent=None, parents=None, rule="inherit"):
+        self.name = name
+        self.service = service
+        self.parent = parent
+        self.parents = parents
+        self.rule = rule
+
+    @property
+    def type_filter(self):
+        return "{}:{}".format(self.service, self.name)
+
+    def mount(self, rules, missing_keys, tags, parent_tags, name_suffix=None):
+        """Tags to apply for the missing keys """
+        if self.rule == 'instance':
+            return rules.instance_tags(missing_keys, parent_tags, tags)
+
+        parent_tags = rules.filter(parent_tags)
+        tags_to_apply = rules.volume_tags(missing_keys, parent_tags)
+        if name_suffix and 'Name' in tags_to_apply:
+            tags_to_apply["Name"] += " " + name_suffix
+        return tags_to_apply
+
+    def __repr__(self):
+        return "ResourceType({})".format(self.type_filter)
+
+
+def parse_arn(arn):
+    """Returns the (type, id) of the ARN """
+    resource = arn.split(':', 5)[5]
+    type_name, _, resource_id = resource.partition('/')
+    return type_name, resource_id
+
+
+def instance_parents(aws, ids):
+    for reservation in aws.iter_describe_by_ids("describe_instances", "Reservations", "instance-id", ids):
+        for i in reservation["Instances"]:
+            yield i["InstanceId"], i.get("VpcId"), None
+
+
+def volume_parents(aws, ids):
+    for v in aws.iter_volumes_by_ids(ids):
+        for a in v["Attachments"][:1]:
+            yield v["VolumeId"], a["InstanceId"], a.get("Device")
+
+
+def snapshot_parents(aws, ids):
+    for s in aws.iter_describe_by_ids("describe_snapshots", "Snapshots", "snapshot-id", ids,
+                                      OwnerIds=['self']):
+        yield s["SnapshotId"], s["VolumeId"], None
+
+
+def network_interface_parents(aws, ids):
+    for n in aws.iter_describe_by_ids("describe_network_interfaces", "NetworkInterfaces",
+                                      "network-interface-id", ids):
+        instance_id = n.get("Attachment", {}).get("InstanceId")
+        if instance_id:
+            yield n["NetworkInterfaceId"], instance_id, None
+
+
+def elastic_ip_parents(aws, ids):
+    for a in aws.iter_describe_by_ids("describe_addresses", "Addresses", "allocation-id", ids):
+        if a.get("InstanceId"):
+            yield a["AllocationId"], a["InstanceId"], None
+
+
+# Parents are defined before their children, the tags applied to a
+# parent are inherited by the children on the same run.
+registry = {}
+for t in [
+    ResourceType("vpc"),
+    ResourceType("instance", parent="vpc", parents=instance_parents, rule="instance"),
+    ResourceType("volume", parent="instance", parents=volume_parents),
+    ResourceType("snapshot", parent="volume", parents=snapshot_parents),
+    ResourceType("network-interface", parent="instance", parents=network_interface_parents),
+    ResourceType("elastic-ip", parent="instance", parents=elastic_ip_parents),
+]:
+    registry[t.name] = t
+
+
+def get_types(names):
+    """
+    Types of the names and their ancestors (loaded on the same stream
+    to get the tags to inherit), in the order of the registry.
+    """
+    selected = set()
+    for name in names:
+        if name not in registry:
+            raise ValueError("Unknown resource type: {}".format(name))
+        while name is not None and name not in selected:
+            selected.add(name)
+            name = registry[name].parent
+    return [t for name, t in registry.items() if name in selected]
@@ -1,60 +1,102 @@
-import copy
 import json
+import logging
 import os
-from pprint import pprint
+import queue
+import time
 
 from aws import AWS
+import debounce
+from inventory import Instance, TagSets, Volume
+import profiling
+import resource_types
+import rules
 import utils
 
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
 class Resources(object):
-    def __init__(self):
+    def __init__(self, region=None, role_arn=None):
         self.instances = {}
         self.volumes = {}
-        self.snapshots = {}
-        self.filtered_tag_keys = []
-        self.require_tags_instance = []
+        # volumes released from self.volumes once tagged, see release_volume()
+        self.released_volumes = 0
+        self.total_snapshots = 0
+        self.tag_sets = TagSets()
+        self.rules = None
+        self.debouncer = None
         self.metric_prefix = 'resource_tagger_'
         self.metrics = {}
-        self.aws = AWS()
-
-        self.tag_default_copy_key = ''
-        self.tag_default_copy_split = ['-', 2]
+        self.aws = AWS(region=region, role_arn=role_arn)
+
+        self.tag_batch_size = 1000
+        self.tag_pending_size = 10000
+        self.event_batch_size = 100
+        self.tag_snapshots = True
+        self.tagging_api_types = []
+        self.tag_enforce = None
+        self.volume_filters = []
+        self.volume_page_size = 500
+
+        # Incremental discovery, see set_checkpoint()
+        self.since = None
+        self.capture_time = None
+        self.full_run_at = None
+
+        # Resumable discovery, see set_cursor()
+        self.deadline = None
+        self.cursor = None
+        self.next_cursor = None
+        self.lookup_instances = False
 
         self.setup()
     
     def setup(self):
         self.instances.clear()
         self.volumes.clear()
-        self.snapshots.clear()
-
-        # Filters
-        fk = os.getenv("TAG_FILTER_KEYS_INSTANCE" or [])
-        if isinstance(fk, list):
-            self.filtered_tag_keys = fk
-        elif isinstance(fk, str):
-            self.filtered_tag_keys =fk.split(',')
-        else:
-            self.filtered_tag_keys = []
-        
-        # Require tags for Instance
-        rt = os.getenv("TAG_REQUIRED_KEYS_INSTANCE" or [])
-        if isinstance(rt, list):
-            self.require_tags_instance = rt
-        elif isinstance(rt, str):
-            self.require_tags_instance =rt.split(',')
-        else:
-            self.require_tags_instance = []
-
-        # Copy tag value when it's defined
-        self.tag_default_copy_key = os.getenv("TAG_DEFAULT_COPY_KEY" or '')
-        ts = os.getenv("TAG_DEFAULT_COPY_SPLIT" or '')
-        if isinstance(ts, list):
-            self.tag_default_copy_split = ts
-        elif isinstance(ts, str):
-            self.tag_default_copy_split =ts.split(',')
-        else:
-            self.tag_default_copy_split = []
+        self.released_volumes = 0
+        self.total_snapshots = 0
+        self.tag_sets.clear()
+
+        # Filters, required tags and default values (see rules.TagRules)
+        self.rules = rules.get_rules()
+
+        # Skip events of resources processed in the last DEBOUNCE_WINDOW seconds
+        self.debouncer = debounce.get_debouncer()
+
+        # Max resources per create_tags call (EC2 API limit is 1000)
+        self.tag_batch_size = int(os.getenv("TAG_BATCH_SIZE", 1000))
+        # Max volume IDs waiting on the batches of the discovery, all the
+        # batches are written when reached
+        self.tag_pending_size = int(os.getenv("TAG_PENDING_SIZE", 10000))
+
+        # Max instance IDs per describe_instances call when processing events
+        self.event_batch_size = int(os.getenv("EVENT_BATCH_SIZE", 100))
+
+        # Tag snapshots on discovery, with the tags of the source volume
+        self.tag_snapshots = os.getenv("TAG_SNAPSHOTS", 'true').lower() in ['true', '1', 'yes']
+
+        # Enforce the tags on tagged volumes: 'missing' keys or 'changed' values
+        self.tag_enforce = os.getenv("TAG_ENFORCE", '').lower() or None
+        if self.tag_enforce not in [None, 'missing', 'changed']:
+            raise ValueError("Invalid TAG_ENFORCE: {}".format(self.tag_enforce))
+
+        # Filters of describe_volumes, <name>=<value>|<value>,... only the
+        # attached volumes receive the instance tags
+        self.volume_filters = []
+        for f in os.getenv("VOLUME_FILTERS", "attachment.status=attached").split(','):
+            name, _, values = f.partition('=')
+            if name and values:
+                self.volume_filters.append({"Name": name.strip(), "Values": values.split('|')})
+
+        # Volumes per describe_volumes page (EC2 API max: 500)
+        self.volume_page_size = int(os.getenv("VOLUME_PAGE_SIZE", 500))
+
+        # Types to enforce with the Resource Groups Tagging API (see resource_types)
+        self.tagging_api_types = rules.split_env("TAGGING_API_TYPES")
+
+        # Seconds between full discovery runs when using checkpoints
+        self.full_interval = int(os.getenv("DISCOVERY_FULL_INTERVAL", 86400))
 
         # Metrics
         self.metrics = {
@@ -64,159 +106,660 @@ class Resources(object):
         }
 
 
-    def load_info_instances(self):
-        for instance in self.aws.get_instances():
-            try:
-                i = self.instances[instance["resourceId"]]
-            except KeyError:
-                self.instances[instance["resourceId"]] = {}
-                i = self.instances[instance["resourceId"]]
-                i["volumes"] = {}
-                i["volumes_ebs"] = {}
-            i["tags"] = copy.deepcopy(utils.tag_list_to_dict(instance["tags"]))
-            try:
-                i["imageId"] = instance["configuration"]["imageId"]
-            except:
-                pass
+    def load_info_instances(self, arrived=None):
+        """
+        Load instances from Config as the pages arrive, keeping only
+        the filtered tags and the device map used by the volumes.
+        The ID of each loaded instance is put on the queue arrived.
+        Returns False when stopped by the deadline.
+        """
+        for instance in self.aws.iter_instances(since=self.since):
+            if self.time_is_up():
+                return False
+            self.add_capture_time(instance.get("configurationItemCaptureTime"))
+            i = self.instances.get(instance["resourceId"]) or Instance()
+            i.tags = self.tag_sets.get(self.tag_filter(utils.tag_list_to_dict(instance["tags"])))
             for b in instance["configuration"]["blockDeviceMappings"]:
                 try:
-                    i["volumes_ebs"][b["ebs"]["volumeId"]] = b["deviceName"]
+                    i.volumes_ebs[b["ebs"]["volumeId"]] = b["deviceName"]
                 except KeyError:
-                    i["volumes"][b["deviceName"]] = b
+                    i.volumes[b["deviceName"]] = b
+
+            # only complete instances are visible to the volumes thread
+            self.instances[instance["resourceId"]] = i
+            if arrived is not None:
+                arrived.put(instance["resourceId"])
+        return True
 
-    def init_info_instances(self):
+    def add_capture_time(self, capture_time):
+        """Advance the capture time of the checkpoint, see set_checkpoint() """
+        if capture_time and (self.capture_time is None or capture_time > self.capture_time):
+            self.capture_time = capture_time
+
+    def load_info_instances_api(self, instance_ids):
+        """
+        Load instances from EC2 API, used on incremental runs to get the
+        instances not changed since the checkpoint (not returned by Config).
+        """
+        instances = self.aws.get_instances_tags_api(instance_ids, batch_size=self.event_batch_size)
+        for instance_id in instance_ids:
+            # tags None is NotFound, see add_info_volume()
+            self.instances[instance_id] = Instance()
+
+        found = list(instances.values())
+        tags_list = self.rules.filter_many([utils.tag_list_to_dict(i["Tags"]) for i in found])
+        for instance, tags in zip(found, tags_list):
+            i = self.instances[instance["InstanceId"]]
+            i.tags = self.tag_sets.get(tags)
+            for b in instance["BlockDeviceMappings"]:
+                try:
+                    i.volumes_ebs[b["Ebs"]["VolumeId"]] = b["DeviceName"]
+                except KeyError:
+                    i.volumes[b["DeviceName"]] = b
+
+    def init_info_instances(self, arrived=None):
         """Init will load instances to dict only if the instances is empty """
         if len(self.instances) <= 0:
-            self.load_info_instances()
-        return
+            with self.aws.run_metrics.timer("config_load"):
+                return self.load_info_instances(arrived)
+        return True
 
     def load_info_volumes(self):
         """Load all valumes that has not tags """
+        for vol in self.iter_info_volumes():
+            pass
 
-        self.init_info_instances()
+    def iter_info_volumes(self):
+        """
+        Generator of the volumes that has not tags, joined with the
+        instance tags as the describe_volumes pages arrive. Each volume
+        is added to self.volumes and its ID is yielded. When tag_enforce
+        is set, the tagged volumes missing tags are yielded too.
+        """
 
-        volumes = self.aws.get_volumes()
-        for vol in volumes:
-            if 'Tags' in volumes[vol]:
-                # Ignor volumes that alread have tags.
-                # TODO: enforce default tags when it's not present.
+        pending = []
+        for v in self.iter_untagged_volumes():
+            # Incremental and resumed runs have only the changed instances (or
+            # none), the others are loaded from EC2 API in batches.
+            if (self.since or self.lookup_instances) and [a for a in v["Attachments"] if a['InstanceId'] not in self.instances]:
+                pending.append(v)
+                if len(pending) < self.event_batch_size:
+                    continue
+            else:
+                vol = self.add_info_volume(v)
+                if vol is not None:
+                    yield vol
                 continue
 
-            v = copy.deepcopy(volumes[vol])
-            if vol not in self.volumes:
-                self.volumes[vol] = {}
-            
-            if v['SnapshotId'] != "":
-                self.volumes[vol]["snapshoot"] = v['SnapshotId']
-                try:
-                    s = self.snapshots[v['SnapshotId']]
-                except KeyError:
-                    self.snapshots[v['SnapshotId']] = {}
-                    s = self.snapshots[v['SnapshotId']]
-                s["volume_id"] = vol
-            
-            if len(v["Attachments"]) > 0:
-                for a in v["Attachments"]:
-                    try:
-                        cur_tags = self.tag_filter(self.instances[a['InstanceId']]["tags"])
-                        # self.volumes[vol]["instance_tags"] = new_tags
-                    except KeyError:
-                        cur_tags = {
-                            "error": "Instance tag's is NotFound."
-                        }
-                    self.volumes[vol]["instance_attached"] = a['InstanceId']
-                    self.volumes[vol]["attached"] = "yes"
-                    new_tags = copy.deepcopy(cur_tags)
-                    try:
-                        device = self.instances[a['InstanceId']]["volumes_ebs"][vol]
-                    except KeyError:
-                        device = ''
-                    if 'Name' in new_tags:
-                        new_tags["Name"] += " " + device
-                    self.volumes[vol]["tags"] = new_tags
-            else:
-                self.volumes[vol]["attached"] = "no"
+            for vol in self.add_info_volumes_pending(pending):
+                yield vol
+            pending = []
+
+        for vol in self.add_info_volumes_pending(pending):
+            yield vol
 
         return
 
+    def iter_untagged_volumes(self):
+        """
+        Generator of the volumes that has not tags. The instances are
+        loaded from Config on a thread while the describe_volumes pages
+        arrive: a volume which the instance was not loaded yet waits for
+        it, the volumes left when Config ends are yielded at last.
+        Ends on the deadline, setting next_cursor to the first page with
+        volumes not yielded.
+        """
+        loader = None
+        if len(self.instances) <= 0 and not self.lookup_instances and not self.since:
+            from concurrent.futures import ThreadPoolExecutor
+
+            arrived = queue.Queue()
+            executor = ThreadPoolExecutor(max_workers=1)
+            loader = executor.submit(self.init_info_instances, arrived)
+            executor.shutdown(wait=False)
+
+        cursor = self.cursor or {}
+        tokens = []
+        waiting = {}
+        waiting_pages = {}
+        for v in self.iter_cursor_volumes(cursor, tokens, waiting_pages, waiting):
+            if 'Tags' in v and not self.tag_enforce:
+                # Ignor volumes that alread have tags.
+                continue
+
+            if loader is not None:
+                for w in self.pop_arrived_volumes(arrived, waiting):
+                    yield w
+                # volumes wait until Config is complete (not stopped by the deadline)
+                if not (loader.done() and loader.result()) and self.wait_instance(v, waiting):
+                    waiting_pages[v['VolumeId']] = len(tokens) - 1
+                    continue
+            yield v
+
+        if loader is None or self.next_cursor is not None:
+            return
+
+        if not loader.result() and waiting:
+            # Config was stopped by the deadline after the last page
+            self.stop_volumes(cursor, tokens, waiting_pages, waiting, None)
+            return
+        for w in self.pop_arrived_volumes(arrived, waiting):
+            yield w
+        for volumes in waiting.values():
+            for w in volumes:
+                yield w
+
+    def iter_cursor_volumes(self, cursor, tokens, waiting_pages, waiting):
+        """
+        Generator of the volumes from the cursor page, the token of each
+        page is appended to tokens. On the deadline, the first page with
+        waiting volumes (or the next one) is saved on next_cursor.
+        """
+        # the filters of the cursor (shard) replace the ones with same name
+        filters = cursor.get("filters") or []
+        names = set([f["Name"] for f in filters])
+        filters = [f for f in self.volume_filters if f["Name"] not in names] + filters
+
+        if self.since:
+            pages = self.iter_volume_pages_since(cursor.get("token"), filters)
+        else:
+            pages = self.aws.iter_volume_pages(cursor.get("token"), filters, self.volume_page_size or None)
+        for token, volumes in pages:
+            if self.time_is_up():
+                self.stop_volumes(cursor, tokens, waiting_pages, waiting, token)
+                return
+            tokens.append(token)
+            for v in volumes:
+                yield v
+
+    def iter_volume_pages_since(self, token, filters):
+        """
+        Generator of (token, volumes) of the incremental discovery: the
+        volumes of the instances changed since the checkpoint (the page
+        None), then the volumes changed since the checkpoint on Config.
+        """
+        seen = set()
+        if token is None:
+            self.load_info_instances()
+            for instance in self.instances.values():
+                seen.update(instance.volumes_ebs)
+            yield None, list(self.aws.iter_volumes_by_ids(list(seen), filters=filters))
+
+        for token, volumes, capture_times in self.aws.iter_volume_pages_since(self.since, token, filters):
+            for capture_time in capture_times:
+                self.add_capture_time(capture_time)
+            yield token, [v for v in volumes if v['VolumeId'] not in seen]
+
+    def stop_volumes(self, cursor, tokens, waiting_pages, waiting, token):
+        """Set next_cursor to the first page with waiting volumes, or token """
+        pending = [waiting_pages[v['VolumeId']] for w in waiting.values() for v in w]
+        if pending:
+            token = tokens[min(pending)]
+        self.next_cursor = dict(cursor, phase="volumes", token=token)
+        print("Deadline reached, discovery stopped on volumes page {}".format(len(tokens)))
+
+    def wait_instance(self, v, waiting):
+        """Add the volume to waiting when an instance was not loaded yet """
+        for a in v["Attachments"]:
+            if a['InstanceId'] not in self.instances:
+                waiting.setdefault(a['InstanceId'], []).append(v)
+                return True
+        return False
+
+    def pop_arrived_volumes(self, arrived, waiting):
+        """Returns the waiting volumes which the instances arrived """
+        volumes = []
+        while True:
+            try:
+                instance_id = arrived.get_nowait()
+            except queue.Empty:
+                break
+            for v in waiting.pop(instance_id, []):
+                if not self.wait_instance(v, waiting):
+                    volumes.append(v)
+        return volumes
+
+    def add_info_volumes_pending(self, volumes):
+        """Add volumes which the instances was not loaded yet """
+        self.load_info_instances_missing(volumes)
+        return [vol for vol in [self.add_info_volume(v) for v in volumes] if vol is not None]
+
+    def load_info_instances_missing(self, volumes):
+        """Load from EC2 API the instances of the volumes not loaded yet """
+        instance_ids = set()
+        for v in volumes:
+            for a in v["Attachments"]:
+                if a['InstanceId'] not in self.instances:
+                    instance_ids.add(a['InstanceId'])
+        if instance_ids:
+            self.load_info_instances_api(list(instance_ids))
+
+    def add_info_volume(self, v):
+        """
+        Join the volume with the instance tags, returns the VolumeId.
+        The tags of a tagged volume are only the delta to the instance
+        tags (see tag_enforce), None is returned when there is no delta.
+        """
+        with self.aws.run_metrics.timer("tag_computation"):
+            vol = v['VolumeId']
+            try:
+                volume = self.volumes[vol]
+            except KeyError:
+                volume = self.volumes[vol] = Volume()
+            self.mount_info_volume(v, volume)
+
+            if 'Tags' not in v:
+                return vol
+
+            volume.tagged = True
+            if not volume.attached:
+                del self.volumes[vol]
+                return None
+            if volume.error is None and not volume.tags:
+                # compliant volume, nothing to write
+                del self.volumes[vol]
+                return None
+
+            return vol
+
+    def mount_info_volume(self, v, volume=None):
+        """Volume (default: a new one) with the tags inherited from the instance """
+        if volume is None:
+            volume = Volume()
+        vol = v['VolumeId']
+        if v['SnapshotId'] != "":
+            volume.snapshot_id = v['SnapshotId']
+
+        for a in v["Attachments"]:
+            volume.instance_id = a['InstanceId']
+            volume.attached = True
+            instance = self.instances.get(a['InstanceId'])
+            if instance is None or instance.tags is None:
+                volume.error = "Instance tag's is NotFound."
+                volume.tags = None
+                continue
+
+            volume.error = None
+            volume.tags = instance.tags
+            volume.device = instance.volumes_ebs.get(vol, '')
+            if 'Tags' in v:
+                # the delta is only of this volume, it's not interned
+                volume.tags = self.rules.delta(utils.tag_list_to_dict(v["Tags"]), volume.tags_to_apply(),
+                                               changed=self.tag_enforce == 'changed')
+                volume.device = None
+        return volume
+
+    def set_cursor(self, cursor):
+        """
+        Resume the discovery from the cursor of a previous run (see
+        next_cursor): {phase, token, filters, all_phases, checkpoint}. The instances
+        are looked up on EC2 API only for the volumes found, instead of
+        loading all of them from Config again.
+        """
+        self.cursor = cursor
+        self.lookup_instances = True
+
+    def time_is_up(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def set_checkpoint(self, checkpoint, continued=False):
+        """
+        Set the checkpoint of the last run (see get_checkpoint()). The
+        next discovery will query only the instances and volumes changed
+        since the last Config capture time (the watermark), unless the
+        last full run is older than full_interval.
+        A continued run (see set_cursor()) takes the checkpoint of the
+        previous invocations as is, with the watermark it started from.
+        """
+        if "configurationItemCaptureTime" not in self.aws.config_queries["instances"]:
+            print("WARN - configurationItemCaptureTime is not selected by CONFIG_QUERY_INSTANCES, "
+                  "the checkpoint is not advanced")
+        now = time.time()
+        self.full_run_at = now
+        if not checkpoint:
+            return
+        if continued:
+            self.since = checkpoint.get("since")
+            self.capture_time = checkpoint.get("capture_time")
+            self.full_run_at = checkpoint["full_run_at"]
+            return
+        if now - checkpoint.get("full_run_at", 0) >= self.full_interval or not checkpoint.get("capture_time"):
+            print("Checkpoint expired, running full discovery")
+            return
+
+        self.since = checkpoint["capture_time"]
+        self.capture_time = self.since
+        self.full_run_at = checkpoint["full_run_at"]
+        print("Incremental discovery since {}".format(self.since))
+
+    def get_checkpoint(self):
+        return {
+            "capture_time": self.capture_time,
+            "since": self.since,
+            "full_run_at": self.full_run_at
+        }
+
+    def target(self):
+        """Region and role of the account being tagged, when defined."""
+        return "/".join([t for t in [self.aws.region, self.aws.role_arn] if t])
+
     def show_report(self):
+        if self.target():
+            print(">> Target: {}".format(self.target()))
+
         if LOG_LEVEL == "DEBUG":
+            from pprint import pprint
+
             print(">> EC2 Instances: ")
             pprint(self.instances)
-            
-            print(">> Snapshoots: ")
-            pprint(self.snapshots)
-            
-            print(">> Untagged volumes: ")
-            pprint(self.volumes)
         
-        msg = ("Total untagged volumes: {}".format(len(self.volumes)))
+        msg = ("Total untagged volumes: {}".format(self.total_volumes()))
         #logger.info(msg)
         print(msg)
-        msg = ("Total snapshoots to tag: {}".format(len(self.snapshots)))
+        msg = ("Total untagged snapshoots: {}".format(self.total_snapshots))
         #logger.info(msg)
         print(msg)
+        if profiling.timings:
+            phases = self.aws.run_metrics.phases
+            print("Timings (s): {}".format(json.dumps(
+                dict([(p, round(seconds, 3)) for p, seconds in sorted(phases.items())]))))
+        if LOG_LEVEL == "DEBUG":
+            print("Cache stats: {}".format(self.aws.cache_stats()))
+            print("Scheduler stats: {}".format(self.aws.scheduler.get_stats()))
 
-    def add_metrics(self):
-        self.aws.add_metrics(
+    def add_metrics(self, aws=None):
+        """
+        Add metrics to be pushed by aws (default: self.aws). Region and
+        account dimensions are added when the target was defined, so
+        several targets could be reported by the same AWS object.
+        """
+        aws = aws or self.aws
+        dimensions = []
+        if self.aws.region:
+            dimensions.append({"Name": "region", "Value": self.aws.region})
+        if self.aws.role_arn:
+            dimensions.append({"Name": "role", "Value": self.aws.role_arn})
+
+        aws.add_metrics(
             data={
                 "name": "total_untagged_resources",
-                "value": len(self.volumes),
-                "dimensions": {
+                "value": self.total_volumes(),
+                "dimensions": [{
                     "Name": "resource",
                     "Value": "volumes"
-                }
+                }] + dimensions
             }
         )
+        if self.tag_snapshots:
+            aws.add_metrics(
+                data={
+                    "name": "total_untagged_resources",
+                    "value": self.total_snapshots,
+                    "dimensions": [{
+                        "Name": "resource",
+                        "Value": "snapshots"
+                    }] + dimensions
+                }
+            )
+        for data in self.aws.run_metrics.get_data(dimensions):
+            aws.add_metrics(data=data)
 
     def tag_filter(self, tags):
-        tags_filtered = {}
-        tags_filtered.clear()
-        for t in tags:
-            if t in self.filtered_tag_keys:
-                tags_filtered.update({t: tags[t]})
-        return tags_filtered
+        return self.rules.filter(tags)
 
-    def apply_tags_volumes(self):
+    def release_volume(self, vol):
+        """
+        Drop the record of a volume already batched (or ignored), to keep
+        the memory bounded on large fleets. Counted on total_volumes().
+        """
+        if self.volumes.pop(vol, None) is not None:
+            self.released_volumes += 1
 
-        self.load_info_volumes()
+    def total_volumes(self):
+        """Untagged volumes found, including the released ones """
+        return len(self.volumes) + self.released_volumes
+
+    def apply_tags_volumes(self):
 
         messages = []
-        if len(self.volumes) <= 0:
-            return
-        for vol in self.volumes.keys():
+        batches = {}
+        pending = 0
+        for vol in self.iter_info_volumes():
             volume = self.volumes[vol]
+            self.release_volume(vol)
 
-            try:
-                if volume["attached"] != "yes":
-                    messages.append("ignoring volume {}=unattached to instance".format(vol))
-                    continue
-            except KeyError:
-                pass
-            try:
-                if len(volume["tags"]) <= 0:
-                    messages.append("ignoring volume {}=empty tags".format(vol))
-                    continue
-                if 'error' in volume["tags"]:
-                    messages.append("ignoring volume {}={}".format(vol, str(volume["tags"]) ))
-                    continue
-            except KeyError as e:
-                messages.append("ignoring volume {}=KeyError {}".format(vol, e))
+            if not volume.attached:
+                messages.append("ignoring volume {}=unattached to instance".format(vol))
+                continue
+            if volume.error:
+                messages.append("ignoring volume {}={}".format(vol, volume.error))
+                continue
+            if not volume.tags:
+                messages.append("ignoring volume {}=empty tags".format(vol))
                 continue
 
-            msg = ("{}={}".format(vol, str(volume["tags"])))
-            logging.info(msg)
-            messages.append(msg)
-            self.aws.clients["ec2"].create_tags(
-                    Resources=[vol],
-                    Tags=utils.tag_dict_to_list(volume["tags"]))
+            tags_key = utils.tag_dict_key(volume.tags_to_apply())
+            batches.setdefault(tags_key, []).append(vol)
+            pending += 1
+
+            # flush full batches while the volumes are arriving, and all
+            # of them when too many IDs are waiting (many tag sets)
+            if len(batches[tags_key]) >= self.tag_batch_size:
+                flushed = batches.pop(tags_key)
+                pending -= len(flushed)
+                messages += self.apply_tags_batches({tags_key: flushed})
+            elif pending >= self.tag_pending_size:
+                messages += self.apply_tags_batches(batches)
+                batches = {}
+                pending = 0
+            if len(messages) >= self.tag_batch_size:
+                print("Tags applied to volumes: {}".format(json.dumps(messages)))
+                messages = []
+
+        if self.total_volumes() <= 0:
+            return
+        messages += self.apply_tags_batches(batches)
         print("Tags applied to volumes: {}".format(json.dumps(messages)))
         return
 
+    def apply_tags_batches(self, batches, resource_type="volumes", apply_tags=None, batch_size=None):
+        """
+        Apply tags to groups of resources that share the same tag set,
+        where batches is a dict of {tag_dict_key: [resource_id, ...]}.
+        Each group is split in chunks of tag_batch_size resources, one
+        create_tags call (or apply_tags) per chunk, the chunks are applied
+        in parallel by the scheduler. Failed chunks are reported per
+        resource and do not stop the remaining ones.
+        """
+        apply_tags = apply_tags or self.apply_tags_ec2_resources
+        jobs = []
+        for tags_key, resource_ids in batches.items():
+            for chunk in utils.chunks(resource_ids, batch_size or self.tag_batch_size):
+                jobs.append((dict(tags_key), chunk))
+
+        def apply(job):
+            tags, chunk = job
+            return apply_tags(chunk, utils.tag_dict_to_list(tags))
+
+        messages = []
+        with self.aws.run_metrics.timer("tag_writes"):
+            results = self.aws.scheduler.map(apply, jobs)
+        for (tags, chunk), (_, error) in zip(jobs, results):
+            if error is not None:
+                for rid in chunk:
+                    messages.append("error tagging {}={}".format(rid, error))
+                continue
+
+            self.aws.run_metrics.add_tagged(resource_type, len(chunk))
+            for rid in chunk:
+                msg = ("{}={}".format(rid, str(tags)))
+                logging.info(msg)
+                messages.append(msg)
+
+        return messages
+
     def apply_tags_snapshots(self):
-        "TODO: use same tags of Volumes"
+        """
+        Tag the untagged snapshots with the tags of the source volume, in
+        one pass on describe_snapshots: the snapshots are indexed by
+        volume, the tags of each volume are resolved (from the inventory
+        or the API) once per tag_batch_size volumes indexed, and the writes
+        are batched by tag set as for the volumes.
+        Ends on the deadline, setting next_cursor to the next page.
+        """
+        if not self.lookup_instances:
+            self.init_info_instances()
+
+        cursor = self.cursor or {}
+        token = cursor.get("token") if cursor.get("phase") == "snapshots" else None
+        messages = []
+        batches = {}
+        index = {}
+        for token, snapshots in self.aws.iter_snapshot_pages(token):
+            if self.time_is_up():
+                self.next_cursor = dict(cursor, phase="snapshots", token=token)
+                print("Deadline reached, discovery stopped on snapshots")
+                break
+            for snap in snapshots:
+                if 'Tags' in snap:
+                    # Ignor snapshots that alread have tags, as the volumes.
+                    continue
+                self.total_snapshots += 1
+                index.setdefault(snap["VolumeId"], []).append(snap["SnapshotId"])
+
+            if len(index) >= self.tag_batch_size:
+                messages += self.add_snapshots_batches(index, batches)
+                index = {}
+                if len(messages) >= self.tag_batch_size:
+                    print("Tags applied to snapshots: {}".format(json.dumps(messages)))
+                    messages = []
+
+        messages += self.add_snapshots_batches(index, batches)
+        messages += self.apply_tags_batches(batches, resource_type="snapshots")
+        print("Tags applied to snapshots: {}".format(json.dumps(messages)))
         return
 
+    def add_snapshots_batches(self, index, batches):
+        """
+        Add the snapshots of the index {VolumeId: [SnapshotId, ...]} to the
+        batches with the tags of their volumes, the full batches (or all of
+        them, see tag_pending_size) are written. Returns the messages.
+        """
+        messages = []
+        for vol, tags in self.iter_volumes_tags(list(index.keys())):
+            snapshot_ids = index.pop(vol)
+            if not tags:
+                for snap in snapshot_ids:
+                    messages.append("ignoring snapshot {}=no tags on volume {}".format(snap, vol))
+                continue
+            batches.setdefault(utils.tag_dict_key(tags), []).extend(snapshot_ids)
+
+        for vol, snapshot_ids in index.items():
+            for snap in snapshot_ids:
+                messages.append("ignoring snapshot {}=volume {} not found".format(snap, vol))
+
+        full = dict([(k, ids) for k, ids in batches.items() if len(ids) >= self.tag_batch_size])
+        if sum([len(ids) for ids in batches.values()]) >= self.tag_pending_size:
+            full = dict(batches)
+        for tags_key in full:
+            del batches[tags_key]
+        messages += self.apply_tags_batches(full, resource_type="snapshots")
+        return messages
+
+    def iter_volumes_tags(self, volume_ids):
+        """
+        Generator of (VolumeId, tags) to be inherited by the snapshots:
+        the tags computed for the volumes held by the inventory, the
+        filtered tags of tagged volumes (the volumes tagged by the run
+        are released), or the instance tags of volumes not tagged.
+        """
+        missing = []
+        for vol in volume_ids:
+            # the tags of enforced volumes are only the delta
+            if vol in self.volumes and not self.volumes[vol].tagged:
+                yield vol, self.volumes[vol].tags_to_apply()
+            else:
+                missing.append(vol)
+
+        # the untagged volumes (unattached or not loaded by the discovery
+        # of volumes) are not added to the inventory of volumes
+        untagged = []
+        for v in self.aws.iter_volumes_by_ids(missing):
+            if 'Tags' in v:
+                yield v['VolumeId'], self.tag_filter(utils.tag_list_to_dict(v["Tags"]))
+            elif self.lookup_instances or self.since:
+                untagged.append(v)
+            else:
+                yield v['VolumeId'], self.mount_info_volume(v).tags_to_apply()
+
+        # resumed and incremental runs have not all the instances loaded
+        self.load_info_instances_missing(untagged)
+        for v in untagged:
+            yield v['VolumeId'], self.mount_info_volume(v).tags_to_apply()
+
+    def apply_tags_resource_types(self, names=None):
+        """
+        Tag the resources of the types (default: tagging_api_types) that
+        miss required keys, with the tags of their parents. The resources
+        of the types and of their parents are loaded in one get_resources
+        stream, the relations are described only for the resources to tag.
+        The Tagging API returns only resources that have tags, the
+        untagged ones are left to the discovery of volumes and snapshots.
+        """
+        names = names or self.tagging_api_types
+        types = resource_types.get_types(names)
+
+        index = {}
+        arns = {}
+        missing = {}
+        with self.aws.run_metrics.timer("tagging_api_load"):
+            for r in self.aws.iter_tagged_resources([t.type_filter for t in types]):
+                type_name, rid = resource_types.parse_arn(r["ResourceARN"])
+                tags = self.tag_sets.get(utils.tag_list_to_dict(r["Tags"]))
+                index[rid] = tags
+                if type_name in names and self.check_required_tags(tags):
+                    arns[rid] = r["ResourceARN"]
+                    missing.setdefault(type_name, []).append(rid)
+
+        messages = []
+        for t in types:
+            ids = missing.get(t.name)
+            if not ids:
+                continue
+
+            batches = {}
+            found = set()
+            for rid, parent_id, name_suffix in t.parents(self.aws, ids):
+                found.add(rid)
+                parent_tags = index.get(parent_id)
+                if parent_tags is None:
+                    messages.append("ignoring {}={} {} has not tags".format(rid, t.parent, parent_id))
+                    continue
+
+                tags = index[rid]
+                tags_to_apply = t.mount(self.rules, self.check_required_tags(tags),
+                                        tags, parent_tags, name_suffix)
+                if not tags_to_apply:
+                    continue
+                # the children of the resource inherit the applied tags,
+                # the Name is of this resource, the dict is not interned
+                index[rid] = dict(tags, **tags_to_apply)
+                batches.setdefault(utils.tag_dict_key(tags_to_apply), []).append(arns[rid])
+
+            for rid in ids:
+                if rid not in found:
+                    messages.append("ignoring {}=not found or without {}".format(rid, t.parent))
+
+            # tag_resources accepts up to 20 ARNs
+            messages += self.apply_tags_batches(
+                batches,
+                resource_type="{}s".format(t.name),
+                apply_tags=self.aws.tag_resources,
+                batch_size=20
+            )
+
+        print("Tags applied by Tagging API: {}".format(json.dumps(messages)))
+
     def apply_tags_instances(self):
         """ TODO:
         - use global/default tags.
@@ -227,8 +770,11 @@ class Resources(object):
         return
 
     def apply_tags_ec2_resource(self, resource_id, tags):
-        return self.aws.clients["ec2"].create_tags(
-                    Resources=[resource_id],
+        return self.apply_tags_ec2_resources([resource_id], tags)
+
+    def apply_tags_ec2_resources(self, resource_ids, tags):
+        return self.aws.call("ec2", "create_tags",
+                    Resources=resource_ids,
                     Tags=tags
                 )
 
@@ -249,31 +795,169 @@ class Resources(object):
                 "event": event
             }
 
+    def debounce_key(self, resource_id):
+        return "debounce/{}/{}".format(self.target() or 'default', resource_id)
+
+    def debounce(self, resource_id):
+        """True when the resource was processed in the debounce window """
+        if self.debouncer.seen(self.debounce_key(resource_id)):
+            print("Skipping {}, already processed in the last {}s".format(
+                resource_id, self.debouncer.window))
+            return True
+        return False
+
+    def apply_tags_from_events(self, events):
+        """
+        Process a batch of events. Instance IDs are de-duplicated and
+        fetched with one describe_instances call per event_batch_size IDs.
+        Returns a list with the error of each event (None on success),
+        in the same order of events.
+        """
+        errors = [None] * len(events)
+        instance_events = {}
+        for idx, event in enumerate(events):
+            try:
+                instance_id = event["detail"]["instance-id"]
+            except (KeyError, TypeError):
+                try:
+                    self.apply_tags_from_event(event)
+                except Exception as e:
+                    print("ERR - processing event {}: {}".format(event, e))
+                    errors[idx] = e
+                continue
+            if instance_id not in instance_events and self.debounce(instance_id):
+                continue
+            instance_events.setdefault(instance_id, []).append(idx)
+
+        for chunk in utils.chunks(list(instance_events.keys()), self.event_batch_size):
+            try:
+                instances = self.aws.get_instances_tags_api(chunk)
+            except Exception as e:
+                # One invalid ID fails the whole batch, fallback
+                # to lookup the instances one by one.
+                print("ERR - describe_instances failed for batch, retrying one by one: {}".format(e))
+                instances = None
+
+            # One query for the VPCs not cached of the instances missing tags
+            if instances and len(instances) > 1:
+                vpc_ids = [i.get("VpcId") for i in instances.values()
+                           if self.check_required_tags(utils.tag_list_to_dict(i["Tags"]))]
+                try:
+                    self.aws.load_vpcs(vpc_ids)
+                except Exception as e:
+                    print("ERR - loading VPCs, using one query per VPC: {}".format(e))
+
+            for instance_id in chunk:
+                try:
+                    if instances is None:
+                        instance = self.aws.get_instance_tags_api(instance_id)
+                    else:
+                        instance = instances.get(instance_id, {})
+                    # skipped instances are retried by the next event
+                    if self.process_instance(instance_id, instance):
+                        self.debouncer.mark(self.debounce_key(instance_id))
+                except Exception as e:
+                    print("ERR - processing InstanceID {}: {}".format(instance_id, e))
+                    for idx in instance_events[instance_id]:
+                        errors[idx] = e
+
+        return errors
+
     def process_event_instance(self, event):
 
         instance_id = event["detail"]["instance-id"]
+        if self.debounce(instance_id):
+            return
 
-        print("Processing InstanceID: {}".format(instance_id))
         instance = self.aws.get_instance_tags_api(instance_id)
 
-        if not instance:
-            print("ERR - No Tags or resource found for ID: {}".format(instance_id))
+        resp = self.process_instance(instance_id, instance)
+        if resp:
+            self.debouncer.mark(self.debounce_key(instance_id))
+        return resp
+
+    def process_event_volume(self, event):
+        """
+        Volumes are tagged by the instance they are attached to, so the
+        event is handled as an event of the instance (debounced with the
+        instance events). Unattached volumes are left to the discovery.
+        """
+        try:
+            volume_id = event["resources"][0].split('/')[-1]
+        except (KeyError, IndexError):
+            print("ERR - No volume found on event: {}".format(event))
+            return
+        if self.debounce(volume_id):
             return
 
-        instance_tags = utils.tag_list_to_dict(instance["Tags"])
+        volume = self.aws.get_volume_tags_api(volume_id)
+        if not volume or not volume["Attachments"]:
+            print("Ignoring volume {}=unattached to instance".format(volume_id))
+            return
 
-        missing_keys = self.check_required_tags(instance_tags)
-        if len(missing_keys) <= 0:
-            print("That's OK, all required Tags was defined to resource_id: {}".format(instance_id))
+        resp = self.process_event_instance({
+            "detail": {
+                "instance-id": volume["Attachments"]["InstanceId"]
+            }
+        })
+        if resp:
+            self.debouncer.mark(self.debounce_key(volume_id))
+        return resp
+
+    def process_instance(self, instance_id, instance):
+        """
+        Tag the instance and its volumes. Returns False when the instance
+        was skipped (instance or VPC tags not found yet), True otherwise.
+        """
+        print("Processing InstanceID: {}".format(instance_id))
+
+        tags_to_apply, itags = self.mount_tags_instance(instance_id, instance)
+        if itags is None:
+            return False
+
+        if not tags_to_apply:
             try:
                 self.check_tags_instance_dm(
                     instance["BlockDeviceMappings"],
-                    instance_tags
+                    itags
                 )
             except Exception as e:
                 print("Error - Tagging process was not complete in instance devices: {}".format(e))
                 pass
-            return
+            return True
+
+        self.apply_tags_ec2_resource(
+            resource_id=instance["InstanceId"],
+            tags=utils.tag_dict_to_list(tags_to_apply)
+        )
+        self.aws.invalidate_cache(instance["InstanceId"])
+        self.aws.run_metrics.add_tagged("instances")
+
+        if 'BlockDeviceMappings' not in instance:
+            return True
+
+        self.check_tags_instance_dm(
+            instance["BlockDeviceMappings"],
+            itags
+        )
+        return True
+
+    def mount_tags_instance(self, instance_id, instance):
+        """
+        Returns the tags to apply to the instance and the instance tags
+        inherited by the volumes (with the applied ones), or (None, None)
+        when the instance must be skipped.
+        """
+        if not instance:
+            print("ERR - No Tags or resource found for ID: {}".format(instance_id))
+            return None, None
+
+        instance_tags = utils.tag_list_to_dict(instance["Tags"])
+
+        missing_keys = self.check_required_tags(instance_tags)
+        if len(missing_keys) <= 0:
+            print("That's OK, all required Tags was defined to resource_id: {}".format(instance_id))
+            return {}, instance_tags
 
         try:
             vpc_id = instance["VpcId"]
@@ -283,13 +967,13 @@ class Resources(object):
         vpc = self.aws.get_vpc_tags(vpc_id)
         if len(vpc) <= 0:
             print("ERR - No VPC [{}] found, skipping tagger".format(vpc_id))
-            return
+            return None, None
 
         try:
             vpc_tags = utils.tag_list_to_dict(vpc[0]["tags"])
         except KeyError:
             print("ERR - No VPC [{}] tags found, skipping tagger".format(vpc_id))
-            return
+            return None, None
         except:
             raise
 
@@ -309,88 +993,103 @@ class Resources(object):
             "found_missing_keys": missing_keys
         }
         print(msg)
-        self.apply_tags_ec2_resource(
-            resource_id=instance["InstanceId"],
-            tags=utils.tag_dict_to_list(tags_to_apply)
-        )
+        return tags_to_apply, {**instance_tags, **tags_to_apply}
 
-        if 'BlockDeviceMappings' not in instance:
-            return
+    def apply_tags_instances_bulk(self, instance_ids):
+        """
+        Tag many instances and their volumes: the instances are described
+        with one call per event_batch_size IDs, the volumes of each batch
+        at once, and the writes are grouped by tag set.
+        Returns the messages of the writes.
+        """
+        messages = []
+        for chunk in utils.chunks(instance_ids, self.event_batch_size):
+            try:
+                instances = self.aws.get_instances_tags_api(chunk)
+            except Exception as e:
+                # One invalid ID fails the whole batch, fallback
+                # to lookup the instances one by one.
+                print("ERR - describe_instances failed for batch, retrying one by one: {}".format(e))
+                instances = {}
+                for instance_id in chunk:
+                    try:
+                        instances[instance_id] = self.aws.get_instance_tags_api(instance_id)
+                    except Exception as e:
+                        messages.append("error describing {}={}".format(instance_id, e))
+
+            instance_batches = {}
+            devices = []
+            for instance_id in chunk:
+                instance = instances.get(instance_id)
+                if not instance:
+                    messages.append("ignoring instance {}=not found".format(instance_id))
+                    continue
+                try:
+                    tags_to_apply, itags = self.mount_tags_instance(instance_id, instance)
+                except Exception as e:
+                    messages.append("error processing {}={}".format(instance_id, e))
+                    continue
+                if itags is None:
+                    messages.append("ignoring instance {}=VPC tags not found".format(instance_id))
+                    continue
+                if tags_to_apply:
+                    instance_batches.setdefault(utils.tag_dict_key(tags_to_apply), []).append(instance_id)
+                devices.append((self.volume_devices(instance["BlockDeviceMappings"]), itags))
 
-        return self.check_tags_instance_dm(
-            instance["BlockDeviceMappings"],
-            {**instance_tags, **tags_to_apply}
-        )
+            volume_ids = [vol for volume_devices, _ in devices for vol in volume_devices]
+            volumes = self.aws.get_volumes_tags_api(volume_ids) if volume_ids else {}
+            volume_batches = {}
+            for volume_devices, itags in devices:
+                self.mount_tags_volumes(volume_devices, itags, volumes, volume_batches)
 
-    def check_required_tags(self, instance_tags):
-        missing_keys = []
-        missing_keys.clear()
-        for k in self.require_tags_instance:
-            try:
-                v = instance_tags[k]
-            except KeyError:
-                missing_keys.append(k)
+            messages += self.apply_tags_batches(instance_batches, resource_type="instances")
+            for instance_ids_tagged in instance_batches.values():
+                for instance_id in instance_ids_tagged:
+                    self.aws.invalidate_cache(instance_id)
+            messages += self.apply_tags_batches(volume_batches)
 
-        return missing_keys
+        return messages
+
+    def check_required_tags(self, instance_tags):
+        return self.rules.missing_keys(instance_tags)
 
     def mount_required_tags_instance(self, missing_keys, vpc_tags, instance_tags):
         """
         Check the missing keys and mount the tags to apply based on
         filters, VPC and Instance tags.
         """
-        tags_to_apply = {}
-
-        cnt = 0
-        for k in missing_keys:
-            try:
-                tags_to_apply[k] = vpc_tags[k]
-            except KeyError:
-                try:
-                    if self.tag_default_copy_key not in instance_tags:
-                        continue
-
-                    copy_tag = instance_tags[self.tag_default_copy_key]
-
-                    tag_value = ''
-                    cnt = 0
-                    sep = self.tag_default_copy_split[0]
-                    offset = int(self.tag_default_copy_split[1])
-                    for v in copy_tag.split(sep):
-                        tag_value += v
-                        cnt += 1
-                        if cnt >= offset:
-                            break
-                        tag_value += '-'
-
-                    tags_to_apply[k] = tag_value
-                except Exception as e:
-                    print("Unexpected error: ", e)
-                    raise
-
-        return tags_to_apply
+        return self.rules.instance_tags(missing_keys, vpc_tags, instance_tags)
 
     def mount_required_tags_volume(self, missing_keys, instance_tags, volume_tags):
         """
         Check the missing keys and mount the tags to apply based on
         Required tags (Env var), Instance Tags and Current Volume tags.
         """
-        tags_to_apply = {}
+        return self.rules.volume_tags(missing_keys, instance_tags)
 
-        cnt = 0
-        for k in missing_keys:
-            try:
-                tags_to_apply[k] = instance_tags[k]
-            except KeyError:
-                try:
-                    tags_to_apply[k] = 'missing-value'
-                except Exception as e:
-                    print("Unexpected error: ", e)
-                    raise
+    def check_tags_instance_dm(self, devices, itags):
+        """
+        Apply tags to Instance Devices. The volumes are described in
+        one call and the writes are grouped by tag set.
+        """
+        volume_devices = self.volume_devices(devices)
+        if len(volume_devices) <= 0:
+            return
 
-        return tags_to_apply
+        volumes = {}
+        if itags:
+            volumes = self.aws.get_volumes_tags_api(list(volume_devices))
 
-    def check_tags_instance_dm(self, devices, itags):
-        """Apply tags to Instance Devices """
+        batches = self.mount_tags_volumes(volume_devices, itags, volumes, {})
+        if len(batches) <= 0:
+            return
+
+        messages = self.apply_tags_batches(batches)
+        print("Tags applied to volumes: {}".format(json.dumps(messages)))
+
+    def volume_devices(self, devices):
+        """Returns {VolumeId: DeviceName} of the EBS devices of the map """
+        volume_devices = {}
         for device in devices:
             try:
                 ebs_map = device["Ebs"]
@@ -401,26 +1100,41 @@ class Resources(object):
                 print("Error - Ebs_map on check_tags_instance_dm(): {}".format(e))
                 continue
 
+            volume_devices[ebs_map["VolumeId"]] = device["DeviceName"]
+        return volume_devices
+
+    def mount_tags_volumes(self, volume_devices, itags, volumes, batches):
+        """
+        Add the volumes to the batches ({tag_dict_key: [VolumeId]}) by
+        the tags to apply, volumes is the result of get_volumes_tags_api().
+        """
+        if not itags:
+            for volume_id in volume_devices:
+                print("ignoring volume {}=empty tags".format(volume_id))
+            return batches
+
+        for volume_id, device_name in volume_devices.items():
+            volume = volumes.get(volume_id)
+            if not volume:
+                print("ERR - No Tags or resource found for ID: {}".format(volume_id))
+                continue
+
             try:
-                self.apply_tags_volume(
-                    ebs_map["VolumeId"],
-                    itags,
-                    device["DeviceName"]
-                )
+                tags_to_apply = self.mount_tags_volume_device(volume, itags, device_name)
             except Exception as e:
                 print("Unkwnown error on check_tags_instance_dm(): {}".format(e))
-                pass
+                continue
 
-    def apply_tags_volume(self, volume_id, itags, device_name):
-        if not itags:
-            print("ignoring volume {}=empty tags".format(volume_id))
-            return
-
-        volume = self.aws.get_volume_tags_api(volume_id)
-        if not volume:
-            print("ERR - No Tags or resource found for ID: {}".format(instance_id))
-            return
+            if tags_to_apply:
+                batches.setdefault(utils.tag_dict_key(tags_to_apply), []).append(volume_id)
+        return batches
 
+    def mount_tags_volume_device(self, volume, itags, device_name):
+        """
+        Returns the tags to apply to the volume attached to the
+        instance as device_name, or None when nothing is missing.
+        """
+        volume_id = volume["VolumeId"]
         volume_tags = utils.tag_list_to_dict(volume["Tags"])
 
         missing_keys = self.check_required_tags(volume_tags)
@@ -450,8 +1164,4 @@ class Resources(object):
             "found_missing_keys": missing_keys
         }
         print(msg)
-
-        return self.apply_tags_ec2_resource(
-            resource_id=volume_id,
-            tags=utils.tag_dict_to_list(tags_to_apply)
-        )
+        return tags_to_apply
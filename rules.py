@@ -0,0 +1,126 @@
+import os
+
+
+def split_env(name):
+    return [v for v in os.getenv(name, '').split(',') if v]
+
+
+class TagRules(object):
+    """
+    Tagging rules (env vars) compiled once: set based filters, the
+    parsed default copy rule, map rules and required keys.
+
+    - TAG_FILTER_KEYS_INSTANCE: keys inherited from the instance
+    - TAG_REQUIRED_KEYS_INSTANCE: required keys of instances and volumes
+    - TAG_DEFAULT_COPY_KEY / TAG_DEFAULT_COPY_SPLIT=<sep>,<count>[,<join>]:
+      default value of required keys, from the first elements of the key
+    - FILTER_TAGS_MAP=<source>><dest>,...: create dest with the value of
+      source when dest is not present
+    """
+    def __init__(self, filter_keys=[], required_keys=[], copy_key=None,
+                 copy_split=('-', 2, '-'), tags_map=[]):
+        self.filter_keys = frozenset(filter_keys)
+        self.required_keys = tuple(required_keys)
+        self.copy_key = copy_key or None
+        self.copy_sep, self.copy_count, self.copy_join = copy_split
+        self.tags_map = tuple(tags_map)
+
+    @classmethod
+    def from_env(cls):
+        copy_split = split_env("TAG_DEFAULT_COPY_SPLIT") or ['-', 2]
+        tags_map = []
+        for m in split_env("FILTER_TAGS_MAP"):
+            source, _, dest = m.partition('>')
+            if source and dest:
+                tags_map.append((source, dest))
+
+        return cls(
+            filter_keys=split_env("TAG_FILTER_KEYS_INSTANCE"),
+            required_keys=split_env("TAG_REQUIRED_KEYS_INSTANCE"),
+            copy_key=os.getenv("TAG_DEFAULT_COPY_KEY", ''),
+            copy_split=(
+                copy_split[0],
+                int(copy_split[1]) if len(copy_split) > 1 else 2,
+                # values are joined by '-' unless defined
+                copy_split[2] if len(copy_split) > 2 else '-'
+            ),
+            tags_map=tags_map
+        )
+
+    def filter(self, tags):
+        """Tags inherited from the instance: filtered keys and map rules """
+        tags_filtered = dict([(k, v) for k, v in tags.items() if k in self.filter_keys])
+        for source, dest in self.tags_map:
+            if dest not in tags_filtered and source in tags:
+                tags_filtered[dest] = tags[source]
+        return tags_filtered
+
+    def filter_many(self, tags_list):
+        """Filter the tags of many resources, in bulk """
+        filter_keys = self.filter_keys
+        if self.tags_map:
+            return [self.filter(tags) for tags in tags_list]
+        return [dict([(k, v) for k, v in tags.items() if k in filter_keys]) for tags in tags_list]
+
+    def missing_keys(self, tags):
+        return [k for k in self.required_keys if k not in tags]
+
+    def copy_value(self, tags):
+        """Default value from the copy key, None when it's not present """
+        if self.copy_key is None or self.copy_key not in tags:
+            return None
+        parts = tags[self.copy_key].split(self.copy_sep)
+        return self.copy_join.join(parts[:self.copy_count])
+
+    def instance_tags(self, missing_keys, vpc_tags, instance_tags):
+        """
+        Tags to apply to the instance for the missing keys, from the
+        VPC tags, the map rules or the default copy value.
+        """
+        tags_to_apply = {}
+        copy_value = None
+        for k in missing_keys:
+            if k in vpc_tags:
+                tags_to_apply[k] = vpc_tags[k]
+                continue
+            for source, dest in self.tags_map:
+                if dest == k and source in instance_tags:
+                    tags_to_apply[k] = instance_tags[source]
+                    break
+            else:
+                if copy_value is None:
+                    copy_value = self.copy_value(instance_tags)
+                if copy_value is not None:
+                    tags_to_apply[k] = copy_value
+        return tags_to_apply
+
+    def delta(self, current, desired, changed=False):
+        """
+        Tags of desired missing on current, and the ones with other
+        value when changed is True.
+        """
+        return dict([(k, v) for k, v in desired.items()
+                     if k not in current or (changed and current[k] != v)])
+
+    def volume_tags(self, missing_keys, instance_tags):
+        return dict([(k, instance_tags.get(k, 'missing-value')) for k in missing_keys])
+
+
+rules_cache = {}
+
+
+def get_rules():
+    """Rules compiled from the current env vars, kept across invocations."""
+    key = tuple([os.getenv(name, '') for name in [
+        "TAG_FILTER_KEYS_INSTANCE",
+        "TAG_REQUIRED_KEYS_INSTANCE",
+        "TAG_DEFAULT_COPY_KEY",
+        "TAG_DEFAULT_COPY_SPLIT",
+        "FILTER_TAGS_MAP",
+    ]])
+    try:
+        return rules_cache[key]
+    except KeyError:
+        rules_cache.clear()
+        rules_cache[key] = TagRules.from_env()
+        return rules_cache[key]
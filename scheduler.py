@@ -0,0 +1,146 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import HTTPClientError
+
+
+THROTTLING_ERRORS = [
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestThrottled",
+]
+
+
+def is_throttling(error):
+    try:
+        return error.response["Error"]["Code"] in THROTTLING_ERRORS
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+def is_transient(error):
+    """Server and connection errors, retried without reducing the concurrency """
+    if isinstance(error, HTTPClientError):
+        return True
+    try:
+        return error.response["ResponseMetadata"]["HTTPStatusCode"] >= 500
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+class Scheduler(object):
+    """
+    Run the API calls with bounded parallelism. The concurrency limit
+    is adjusted by AIMD: it grows by one for each window of successful
+    calls and is halved on throttling responses, which are retried with
+    jittered exponential backoff (as the transient errors). The clients
+    don't retry (see aws.scheduled_client_config), each attempt is seen here.
+    """
+    def __init__(self, max_concurrency=8, max_retries=5, base_delay=0.2, max_delay=10):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+        self.stats = {
+            "calls": 0,
+            "throttles": 0,
+            "retries": 0,
+            "errors": 0,
+        }
+
+    def acquire(self):
+        with self.cond:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+            self.stats["calls"] += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.stats["throttles"] += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            throttled = False
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttling(e)
+                if not (throttled or is_transient(e)) or attempt >= self.max_retries:
+                    with self.cond:
+                        self.stats["errors"] += 1
+                    raise
+            finally:
+                self.release(throttled)
+
+            attempt += 1
+            with self.cond:
+                self.stats["retries"] += 1
+            time.sleep(self.backoff(attempt))
+
+    def map(self, fn, items):
+        """
+        Run fn for each item in parallel (fn should use call() for the
+        API requests). Returns a list of (result, error) in the items order.
+        """
+        def run(item):
+            try:
+                return (fn(item), None)
+            except Exception as e:
+                return (None, e)
+
+        items = list(items)
+        if len(items) <= 1 or self.max_concurrency <= 1:
+            return [run(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as pool:
+            return list(pool.map(run, items))
+
+    def get_stats(self):
+        with self.cond:
+            return dict(self.stats,
+                        queue_depth=self.waiting,
+                        in_flight=self.in_flight,
+                        concurrency_limit=int(self.limit))
+
+
+# One per target (region and role), shared by the AWS objects of the
+# process: the throttling of an account doesn't slow down the others.
+# {(region, role): Scheduler}
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(region=None, role_arn=None):
+    key = (region, role_arn)
+    with schedulers_lock:
+        if key not in schedulers:
+            schedulers[key] = Scheduler(
+                max_concurrency=int(os.getenv("SCHEDULER_MAX_CONCURRENCY", 8)),
+                max_retries=int(os.getenv("SCHEDULER_MAX_RETRIES", 5)),
+                base_delay=float(os.getenv("SCHEDULER_BASE_DELAY", 0.2)),
+            )
+        return schedulers[key]
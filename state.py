@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class FileStore(object):
+    """
+    State saved on a local JSON file, {key: value}. The expiration of the
+    keys set with ttl is kept on the key _expires, the expired keys are
+    removed on the writes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            data = self.load()
+        expires_at = data.get("_expires", {}).get(key)
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return data.get(key)
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            data = self.load()
+            now = time.time()
+            expires = data.get("_expires", {})
+            for k in [k for k, expires_at in expires.items() if expires_at < now]:
+                data.pop(k, None)
+                del expires[k]
+            data[key] = value
+            if ttl:
+                expires[key] = now + ttl
+            else:
+                expires.pop(key, None)
+            if expires:
+                data["_expires"] = expires
+            else:
+                data.pop("_expires", None)
+            tmp = "{}.tmp".format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+
+class SQLiteStore(object):
+    """State saved on a local SQLite database, the expired keys are removed on the writes."""
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            try:
+                # databases created before the expiration
+                db.execute("ALTER TABLE state ADD COLUMN expires_at REAL")
+            except sqlite3.OperationalError:
+                pass
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                             (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self.connect() as db:
+            db.execute("DELETE FROM state WHERE expires_at < ?", (now,))
+            db.execute("REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                       (key, json.dumps(value), now + ttl if ttl else None))
+
+
+class S3Store(object):
+    """
+    State saved on S3, one object per key: s3://<bucket>/<prefix>/<key>.json
+    The objects set with ttl are tagged with ttl=<seconds>, to be removed
+    by a lifecycle rule of the bucket (S3 doesn't expire single objects).
+    """
+    def __init__(self, bucket, prefix=''):
+        import aws
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = aws.get_client('s3')
+
+    def object_key(self, key):
+        key = key.replace(':', '_').replace('/', '_')
+        return "/".join([p for p in [self.prefix, "{}.json".format(key)] if p])
+
+    def get(self, key):
+        try:
+            resp = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(resp["Body"].read())
+
+    def set(self, key, value, ttl=None):
+        kwargs = {"Tagging": "ttl={}".format(int(ttl))} if ttl else {}
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.object_key(key),
+            Body=json.dumps(value).encode(),
+            **kwargs
+        )
+
+
+def get_store(url=None):
+    """
+    Get the state store from the url (default: env STATE_STORE):
+    - file:///tmp/aws-resource-tagger.json
+    - sqlite:///tmp/aws-resource-tagger.db
+    - s3://<bucket>/<prefix>
+    Returns None when it's not defined.
+    """
+    url = url or os.getenv("STATE_STORE", '')
+    if not url:
+        return None
+
+    scheme, _, path = url.partition('://')
+    if scheme == 'file':
+        return FileStore(path)
+    if scheme == 'sqlite':
+        return SQLiteStore(path)
+    if scheme == 's3':
+        bucket, _, prefix = path.partition('/')
+        return S3Store(bucket, prefix)
+
+    raise ValueError("Unknown state store: {}".format(url))
@@ -0,0 +1,64 @@
+import time
+
+import aws
+from resources import Resources
+
+
+def test_query_since_wraps_the_conditions():
+    query = "SELECT resourceId WHERE resourceType = 'AWS::EC2::Instance' AND tags.key = 'a' OR tags.key = 'b'"
+    assert aws.query_since(query, "2020-01-01T00:00:00.000Z") == (
+        "SELECT resourceId WHERE (resourceType = 'AWS::EC2::Instance' AND tags.key = 'a' OR tags.key = 'b')"
+        " AND configurationItemCaptureTime >= '2020-01-01T00:00:00.000Z'")
+    assert aws.query_since("SELECT resourceId", "T") == (
+        "SELECT resourceId WHERE configurationItemCaptureTime >= 'T'")
+
+
+def test_first_run_is_full():
+    r = Resources()
+    r.set_checkpoint(None)
+    assert r.since is None
+    r.add_capture_time("2020-01-02T00:00:00.000Z")
+    r.add_capture_time("2020-01-01T00:00:00.000Z")
+    checkpoint = r.get_checkpoint()
+    assert checkpoint["capture_time"] == "2020-01-02T00:00:00.000Z"
+    assert checkpoint["since"] is None
+    assert time.time() - checkpoint["full_run_at"] < 60
+
+
+def test_incremental_run_from_the_watermark():
+    r = Resources()
+    r.set_checkpoint({"capture_time": "2020-01-02T00:00:00.000Z", "full_run_at": time.time() - 60})
+    assert r.since == "2020-01-02T00:00:00.000Z"
+    # the watermark doesn't go back without changes
+    assert r.get_checkpoint()["capture_time"] == "2020-01-02T00:00:00.000Z"
+
+
+def test_expired_checkpoint_runs_full(monkeypatch):
+    monkeypatch.setenv("DISCOVERY_FULL_INTERVAL", "3600")
+    r = Resources()
+    r.set_checkpoint({"capture_time": "2020-01-02T00:00:00.000Z", "full_run_at": time.time() - 7200})
+    assert r.since is None
+    assert time.time() - r.get_checkpoint()["full_run_at"] < 60
+
+    # checkpoints without capture time (not selected by the query) too
+    r = Resources()
+    r.set_checkpoint({"capture_time": None, "full_run_at": time.time()})
+    assert r.since is None
+
+
+def test_missing_capture_time_warns(monkeypatch, capsys):
+    monkeypatch.setenv("CONFIG_QUERY_INSTANCES", "SELECT resourceId, tags WHERE resourceType = 'AWS::EC2::Instance'")
+    Resources().set_checkpoint(None)
+    assert "WARN - configurationItemCaptureTime" in capsys.readouterr().out
+
+
+def test_continued_run_keeps_the_watermark():
+    r = Resources()
+    r.set_checkpoint({
+        "capture_time": "2020-01-03T00:00:00.000Z",
+        "since": "2020-01-02T00:00:00.000Z",
+        "full_run_at": time.time() - 7200
+    }, continued=True)
+    assert r.since == "2020-01-02T00:00:00.000Z"
+    assert r.get_checkpoint()["capture_time"] == "2020-01-03T00:00:00.000Z"
+    assert r.get_checkpoint()["full_run_at"] < time.time() - 3600
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+from aws import AWS
+import benchmark
+import main
+from resources import Resources
+import state
+
+
+@pytest.fixture
+def fleet(monkeypatch, tmp_path):
+    """Synthetic fleet served by the stand-ins of benchmark.py """
+    monkeypatch.setenv("TAG_FILTER_KEYS_INSTANCE", "Name,team")
+    monkeypatch.setenv("TAG_SNAPSHOTS", "false")
+    monkeypatch.setenv("VOLUME_PAGE_SIZE", "10")
+    monkeypatch.setenv("STATE_STORE", "file://{}".format(tmp_path / "state.json"))
+    fleet = benchmark.Fleet(instances=30, snapshot_ratio=0)
+    benchmark.install_stubs(fleet)
+    return fleet
+
+
+@pytest.fixture
+def stop_after(monkeypatch):
+    """The deadline of each invocation is reached after the volume pages """
+    pages = {"seen": 0, "max": None}
+    iter_volume_pages = AWS.iter_volume_pages
+
+    def iter_counted_pages(self, *args, **kwargs):
+        for page in iter_volume_pages(self, *args, **kwargs):
+            pages["seen"] += 1
+            yield page
+
+    monkeypatch.setattr(AWS, "iter_volume_pages", iter_counted_pages)
+    monkeypatch.setattr(Resources, "time_is_up",
+                        lambda self: self.deadline is not None and pages["seen"] > pages["max"])
+
+    def invoke(max_pages, cursor=None):
+        pages.update(seen=0, max=max_pages)
+        return main.discovery_apply_target(cursor=cursor, deadline=time.time() + 3600)
+    return invoke
+
+
+def untagged(fleet):
+    return sorted([v["VolumeId"] for v in fleet.volumes.values() if v["Attachments"] and not v.get("Tags")])
+
+
+def tags(resource):
+    return dict([(t["Key"], t["Value"]) for t in resource.get("Tags", [])])
+
+
+def add_volume(fleet, volume_id, instance_id):
+    fleet.volumes[volume_id] = {
+        "VolumeId": volume_id,
+        "SnapshotId": '',
+        "AvailabilityZone": "us-east-1a",
+        "State": "in-use",
+        "Attachments": [{"InstanceId": instance_id, "Device": "/dev/sdz",
+                         "State": "attached", "VolumeId": volume_id}],
+    }
+    fleet.instances[instance_id]["BlockDeviceMappings"].append(
+        {"DeviceName": "/dev/sdz", "Ebs": {"VolumeId": volume_id}})
+
+
+def test_full_run_saves_the_watermark(fleet):
+    assert untagged(fleet)
+    main.discovery_apply_target()
+    assert untagged(fleet) == []
+    checkpoint = state.get_store().get("default")
+    assert checkpoint["capture_time"] == "2020-01-01T00:00:00.000Z"
+    assert checkpoint["since"] is None
+
+
+def test_incremental_run_describes_only_the_changes(fleet, monkeypatch):
+    instance_ids = sorted(fleet.instances)
+    fleet.changed(instance_ids[3], "2020-06-01T00:00:00.000Z")
+    main.discovery_apply_target()
+
+    # a new volume (changed on Config), a volume of a changed instance
+    # and a volume without changes, which is not seen
+    add_volume(fleet, "vol-changed", instance_ids[0])
+    fleet.changed("vol-changed", "2021-01-01T00:00:00.000Z")
+    add_volume(fleet, "vol-instance", instance_ids[1])
+    fleet.changed(instance_ids[1], "2021-01-02T00:00:00.000Z")
+    add_volume(fleet, "vol-unchanged", instance_ids[2])
+
+    def full_scan(self, *args, **kwargs):
+        raise AssertionError("describe_volumes of all the volumes")
+    monkeypatch.setattr(AWS, "iter_volume_pages", full_scan)
+
+    r = main.discovery_apply_target()
+    assert r.since == "2020-06-01T00:00:00.000Z"
+    assert untagged(fleet) == ["vol-unchanged"]
+    instance_tags = tags(fleet.instances[instance_ids[0]])
+    assert tags(fleet.volumes["vol-changed"]) == {
+        "Name": "{} /dev/sdz".format(instance_tags["Name"]), "team": instance_tags["team"]}
+    assert state.get_store().get("default")["capture_time"] == "2021-01-02T00:00:00.000Z"
+
+
+def test_continued_run_resumes_from_the_cursor(fleet, stop_after):
+    r = stop_after(2)
+    invocations = 1
+    store = state.get_store()
+    assert store.get("default") is None
+    assert r.next_cursor["phase"] == "volumes" and r.next_cursor["checkpoint"]
+    assert store.get("default/continuation")["since"] is None
+
+    while r.next_cursor is not None:
+        assert invocations < 20
+        r = stop_after(2, r.next_cursor)
+        invocations += 1
+
+    assert invocations > 2
+    assert untagged(fleet) == []
+    assert store.get("default")["capture_time"] == "2020-01-01T00:00:00.000Z"
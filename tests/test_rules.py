@@ -0,0 +1,68 @@
+from rules import TagRules
+
+
+def make_rules(**kwargs):
+    kwargs.setdefault("filter_keys", ["Name", "team"])
+    return TagRules(**kwargs)
+
+
+def test_filter_keeps_only_the_filtered_keys():
+    rules = make_rules()
+    tags = {"Name": "web-1", "team": "core", "aws:autoscaling:groupName": "web"}
+    assert rules.filter(tags) == {"Name": "web-1", "team": "core"}
+
+
+def test_filter_applies_the_map_rules():
+    rules = make_rules(tags_map=[("squad", "team"), ("app", "role")])
+    assert rules.filter({"Name": "web-1", "squad": "core", "app": "web"}) == {
+        "Name": "web-1", "team": "core", "role": "web"}
+    # the map doesn't replace a key present
+    assert rules.filter({"team": "infra", "squad": "core"}) == {"team": "infra"}
+
+
+def test_filter_many_matches_filter():
+    tags_list = [
+        {"Name": "web-1", "team": "core", "env": "prod"},
+        {"env": "dev"},
+        {},
+    ]
+    for rules in [make_rules(), make_rules(tags_map=[("env", "team")])]:
+        assert rules.filter_many(tags_list) == [rules.filter(tags) for tags in tags_list]
+
+
+def test_copy_value():
+    rules = make_rules(copy_key="Name", copy_split=('-', 2, '_'))
+    assert rules.copy_value({"Name": "cluster1-web-use1-0"}) == "cluster1_web"
+    assert rules.copy_value({"team": "core"}) is None
+    assert make_rules().copy_value({"Name": "cluster1-web"}) is None
+
+
+def test_instance_tags_sources():
+    rules = make_rules(required_keys=["team", "role", "env"], copy_key="Name",
+                       tags_map=[("app", "role")])
+    instance_tags = {"Name": "cluster1-web-use1-0", "app": "web"}
+    missing = rules.missing_keys(instance_tags)
+    assert missing == ["team", "role", "env"]
+    # VPC tags first, then the map rules, then the copy value
+    assert rules.instance_tags(missing, {"team": "core"}, instance_tags) == {
+        "team": "core", "role": "web", "env": "cluster1-web"}
+
+
+def test_instance_tags_without_copy_value():
+    rules = make_rules(required_keys=["team"])
+    assert rules.instance_tags(["team"], {}, {"Name": "web"}) == {}
+
+
+def test_delta_missing_keys():
+    rules = make_rules()
+    current = {"Name": "old", "env": "prod"}
+    desired = {"Name": "web-1 /dev/sda", "team": "core"}
+    assert rules.delta(current, desired) == {"team": "core"}
+    assert rules.delta(dict(current, team="core"), desired) == {}
+
+
+def test_delta_changed_values():
+    rules = make_rules()
+    current = {"Name": "old", "team": "core"}
+    desired = {"Name": "web-1 /dev/sda", "team": "core", "role": "web"}
+    assert rules.delta(current, desired, changed=True) == {"Name": "web-1 /dev/sda", "role": "web"}
@@ -0,0 +1,109 @@
+import pytest
+
+from scheduler import Scheduler, is_throttling, is_transient
+import scheduler
+
+
+class ClientError(Exception):
+    def __init__(self, code, status=400):
+        super(ClientError, self).__init__(code)
+        self.response = {
+            "Error": {"Code": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+class Flaky(object):
+    """Fails with the errors, then returns ok """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(scheduler.time, "sleep", delays.append)
+    return delays
+
+
+def test_errors_classification():
+    assert is_throttling(ClientError("RequestLimitExceeded"))
+    assert not is_throttling(ClientError("InvalidVolume.NotFound"))
+    assert not is_throttling(ValueError())
+    assert is_transient(ClientError("InternalError", 500))
+    assert not is_transient(ClientError("Throttling"))
+
+
+def test_throttling_halves_the_limit(sleeps):
+    s = Scheduler(max_concurrency=8, base_delay=0.1)
+    fn = Flaky(ClientError("Throttling"), ClientError("Throttling"))
+    assert s.call(fn) == "ok"
+    assert fn.calls == 3
+    assert s.limit == pytest.approx(2 + 1.0 / 2)
+    assert s.get_stats()["throttles"] == 2
+    assert s.get_stats()["retries"] == 2
+
+
+def test_limit_grows_back_to_the_max():
+    s = Scheduler(max_concurrency=4)
+    s.limit = 1.0
+    for _ in range(20):
+        s.call(lambda: None)
+    assert s.limit == 4.0
+
+
+def test_transient_errors_keep_the_limit(sleeps):
+    s = Scheduler(max_concurrency=4)
+    fn = Flaky(ClientError("InternalError", 503))
+    assert s.call(fn) == "ok"
+    assert s.limit == 4.0
+    assert s.get_stats()["throttles"] == 0
+    assert len(sleeps) == 1
+
+
+def test_backoff_is_bounded(sleeps):
+    s = Scheduler(max_retries=3, base_delay=0.5, max_delay=1)
+    for attempt in range(10):
+        assert 0 <= s.backoff(attempt) <= min(1, 0.5 * 2 ** attempt)
+
+    fn = Flaky(*[ClientError("Throttling")] * 5)
+    with pytest.raises(ClientError):
+        s.call(fn)
+    assert fn.calls == 4
+    assert len(sleeps) == 3
+    assert s.get_stats()["errors"] == 1
+
+
+def test_other_errors_are_not_retried(sleeps):
+    s = Scheduler()
+    fn = Flaky(ClientError("UnauthorizedOperation"))
+    with pytest.raises(ClientError):
+        s.call(fn)
+    assert fn.calls == 1
+    assert sleeps == []
+
+
+def test_map_keeps_the_order_and_errors():
+    s = Scheduler(max_concurrency=4)
+
+    def fn(n):
+        if n == 3:
+            raise ValueError(n)
+        return n * 2
+
+    results = s.map(fn, range(6))
+    assert [r for r, _ in results] == [0, 2, 4, None, 8, 10]
+    assert isinstance(results[3][1], ValueError)
+
+
+def test_one_scheduler_per_target():
+    assert scheduler.get_scheduler("us-east-1") is scheduler.get_scheduler("us-east-1")
+    assert scheduler.get_scheduler("us-east-1") is not scheduler.get_scheduler("us-west-2")
+    assert scheduler.get_scheduler("us-east-1", "arn:role") is not scheduler.get_scheduler("us-east-1")
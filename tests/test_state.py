@@ -0,0 +1,70 @@
+import pytest
+
+import state
+
+
+class Clock(object):
+    """Stand-in of the time module used by the stores """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(state, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "file":
+        return state.FileStore(str(tmp_path / "state.json"))
+    return state.SQLiteStore(str(tmp_path / "state.db"))
+
+
+def test_get_set(store):
+    assert store.get("missing") is None
+    store.set("checkpoint", {"capture_time": "2020-01-01T00:00:00.000Z"})
+    assert store.get("checkpoint") == {"capture_time": "2020-01-01T00:00:00.000Z"}
+
+
+def test_ttl_expiry(store, clock):
+    store.set("i-1", 1000.0, ttl=300)
+    store.set("checkpoint", {"full_run_at": 1000.0})
+    clock.now += 299
+    assert store.get("i-1") == 1000.0
+    clock.now += 2
+    assert store.get("i-1") is None
+    # the keys without ttl don't expire
+    assert store.get("checkpoint") == {"full_run_at": 1000.0}
+
+
+def test_set_without_ttl_keeps_the_key(store, clock):
+    store.set("i-1", 1000.0, ttl=300)
+    store.set("i-1", 1000.0)
+    clock.now += 600
+    assert store.get("i-1") == 1000.0
+
+
+def test_expired_keys_are_removed_on_writes(tmp_path, clock):
+    path = str(tmp_path / "state.json")
+    store = state.FileStore(path)
+    store.set("i-1", 1000.0, ttl=300)
+    store.set("i-2", 1000.0, ttl=600)
+    clock.now += 400
+    store.set("i-3", 1400.0, ttl=300)
+    data = store.load()
+    assert "i-1" not in data and "i-1" not in data["_expires"]
+    assert sorted(data["_expires"]) == ["i-2", "i-3"]
+
+    db = state.SQLiteStore(str(tmp_path / "state.db"))
+    db.set("i-1", 1000.0, ttl=300)
+    clock.now += 400
+    db.set("i-2", 1800.0, ttl=300)
+    with db.connect() as conn:
+        keys = [row[0] for row in conn.execute("SELECT key FROM state")]
+    assert keys == ["i-2"]
@@ -16,3 +16,13 @@ def tag_dict_to_list(tags_dict):
         tags_list.append({'Key': k, 'Value': v})
 
     return tags_list
+
+
+def tag_dict_key(tags_dict):
+    """Hashable representation of a tag dict, used to group resources."""
+    return tuple(sorted(tags_dict.items()))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,241 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import queue
+import signal
+import time
+
+from metrics import RunMetrics
+from resources import Resources
+
+
+class SQSQueue(object):
+    """Events from a SQS queue, deleted once processed."""
+    def __init__(self, url, wait=10):
+        import aws
+
+        self.url = url
+        self.wait = wait
+        self.client = aws.get_client('sqs')
+
+    def receive(self, max_messages):
+        resp = self.client.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=self.wait
+        )
+        return [{
+            "id": m["MessageId"],
+            "receipt": m["ReceiptHandle"],
+            "body": m["Body"]
+        } for m in resp.get("Messages", [])]
+
+    def ack(self, messages):
+        if len(messages) <= 0:
+            return
+        self.client.delete_message_batch(
+            QueueUrl=self.url,
+            Entries=[{"Id": m["id"], "ReceiptHandle": m["receipt"]} for m in messages]
+        )
+
+
+class FileQueue(object):
+    """Events from a local file, one JSON event per line. Ends on EOF."""
+    def __init__(self, path):
+        self.file = open(path)
+        self.line = 0
+
+    def receive(self, max_messages):
+        messages = []
+        for line in self.file:
+            self.line += 1
+            if line.strip():
+                messages.append({"id": str(self.line), "body": line})
+            if len(messages) >= max_messages:
+                break
+        if len(messages) <= 0:
+            self.file.close()
+            return None
+        return messages
+
+    def ack(self, messages):
+        return
+
+
+class MemoryQueue(object):
+    """In-process queue of events, ends when close() is called."""
+    closed = object()
+
+    def __init__(self, wait=1):
+        self.wait = wait
+        self.events = queue.Queue()
+        self.count = 0
+        self.done = False
+
+    def put(self, event):
+        self.events.put(event)
+
+    def close(self):
+        self.events.put(self.closed)
+
+    def receive(self, max_messages):
+        if self.done:
+            return None
+        messages = []
+        try:
+            event = self.events.get(timeout=self.wait)
+            while True:
+                if event is self.closed:
+                    self.done = True
+                    break
+                self.count += 1
+                messages.append({"id": str(self.count), "body": event})
+                if len(messages) >= max_messages:
+                    break
+                event = self.events.get_nowait()
+        except queue.Empty:
+            pass
+        if self.done and len(messages) <= 0:
+            return None
+        return messages
+
+    def ack(self, messages):
+        return
+
+
+def get_queue(url=None):
+    """
+    Get the events queue from the url (default: env WORKER_QUEUE):
+    - https://sqs.<region>.amazonaws.com/<account>/<queue>
+    - file:///tmp/events.jsonl
+    - memory://
+    """
+    url = url or os.getenv("WORKER_QUEUE", '')
+    if not url:
+        raise ValueError("Queue not defined, set WORKER_QUEUE")
+
+    scheme, _, path = url.partition('://')
+    if scheme == 'https':
+        return SQSQueue(url, wait=int(os.getenv("WORKER_WAIT", 10)))
+    if scheme == 'file':
+        return FileQueue(path)
+    if scheme == 'memory':
+        return MemoryQueue()
+
+    raise ValueError("Unknown queue: {}".format(url))
+
+
+class Worker(object):
+    """
+    Daemon that pulls the events from a queue and tags the resources,
+    up to concurrency events in flight. The workers share one Resources
+    (caches, clients and debounce). SIGTERM and SIGINT stop receiving,
+    the events in flight are finished before exiting.
+    """
+    def __init__(self, events_queue, concurrency=16, batch_size=10, metrics_interval=60):
+        self.queue = events_queue
+        self.concurrency = concurrency
+        # a batch holds one slot per event
+        self.batch_size = min(batch_size, concurrency)
+        self.metrics_interval = metrics_interval
+        self.resources = Resources()
+        self.stopping = False
+        self.stats = {"received": 0, "processed": 0, "failed": 0}
+
+    def stop(self):
+        if not self.stopping:
+            print("Stopping worker, waiting the events in flight")
+        self.stopping = True
+
+    def run(self):
+        return asyncio.run(self.consume())
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        # receive + one thread per event in flight
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency + 1))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        metrics_at = time.time()
+        while not self.stopping:
+            messages = await loop.run_in_executor(None, self.queue.receive, self.batch_size)
+            if messages is None:
+                break
+            self.stats["received"] += len(messages)
+
+            for _ in messages:
+                await slots.acquire()
+            task = asyncio.ensure_future(self.process(messages, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+            if time.time() - metrics_at >= self.metrics_interval:
+                self.push_metrics()
+                metrics_at = time.time()
+
+        if tasks:
+            await asyncio.wait(tasks)
+        self.push_metrics()
+        print("Worker stopped: {}".format(json.dumps(self.stats)))
+
+    async def process(self, messages, slots):
+        loop = asyncio.get_running_loop()
+        errors = {}
+        events = []
+        valid = []
+        for m in messages:
+            try:
+                events.append(json.loads(m["body"]) if isinstance(m["body"], str) else m["body"])
+                valid.append(m)
+            except Exception as e:
+                print("ERR - invalid message {}: {}".format(m, e))
+                errors[m["id"]] = e
+
+        try:
+            results = await loop.run_in_executor(None, self.resources.apply_tags_from_events, events)
+        except Exception as e:
+            print("ERR - processing {} events: {}".format(len(events), e))
+            results = [e] * len(events)
+        for m, error in zip(valid, results):
+            errors[m["id"]] = error
+
+        done = [m for m in messages if errors[m["id"]] is None]
+        self.stats["processed"] += len(done)
+        self.stats["failed"] += len(messages) - len(done)
+        try:
+            # the failed messages are retried by the queue (visibility timeout)
+            await loop.run_in_executor(None, self.queue.ack, done)
+        except Exception as e:
+            print("ERR - deleting {} messages: {}".format(len(done), e))
+        finally:
+            for _ in messages:
+                slots.release()
+
+    def push_metrics(self):
+        """Same of the event handlers: only on Embedded Metric Format (METRICS_EMF) """
+        aws = self.resources.aws
+        if not aws.metrics_emf:
+            return
+        run_metrics, aws.run_metrics = aws.run_metrics, RunMetrics()
+        for data in run_metrics.get_data():
+            aws.add_metrics(data=data)
+        aws.push_metrics()
+
+
+def run_worker(url=None):
+    """Worker configured by env vars, see README."""
+    worker = Worker(
+        get_queue(url),
+        concurrency=int(os.getenv("WORKER_CONCURRENCY", 16)),
+        batch_size=int(os.getenv("WORKER_BATCH_SIZE", 10)),
+        metrics_interval=int(os.getenv("WORKER_METRICS_INTERVAL", 60))
+    )
+    worker.run()
+    return worker